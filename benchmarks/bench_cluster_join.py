@@ -0,0 +1,112 @@
+"""
+Time for a new node to catch up with a 3 node cluster on loopback.
+
+Two nodes ingest frames while the third is down, then the third starts
+with an empty project directory. With log compaction on it receives a
+SQLite snapshot and replays only the tail; with compaction off it
+replays every replicated command.
+
+    python benchmarks/bench_cluster_join.py [--frames 5000] [--batch 50]
+
+Every node runs in its own process and project directory.
+"""
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+PORTS = (18301, 18302, 18303)
+
+
+def node(directory, index, frames, batch, compaction):
+    os.chdir(directory)
+    sys.path.insert(0, SRC)
+    import asyncio
+    from piebus import conf
+    from piebus.api import Kind, PiebusAPI, ensure_db
+    from piebus.cluster import SQLiteSnapshots, partner_addresses, syncobj_conf
+    ensure_db()
+    section = conf['cluster']
+    snapshots = SQLiteSnapshots(section['self'])
+    api = PiebusAPI(section['self'], partner_addresses(section['partners']), conf=syncobj_conf(section, snapshots))
+    if frames:
+        while not api._getLeader():
+            time.sleep(0.05)
+        loop = asyncio.get_event_loop()
+        for start in range(0, frames, batch):
+            loop.run_until_complete(api.create_frames([
+                dict(kind=Kind.event, name='telegram-message', data={'message_id': i, 'text': f'message {i} ' * 20})
+                for i in range(start, min(start + batch, frames))]))
+        if compaction:
+            # make sure a snapshot exists before the new node starts
+            api.forceLogCompaction()
+            time.sleep(1)
+    print('ready', flush=True)
+    while True:
+        time.sleep(1)
+
+
+def start(root, index, compaction, frames=0, batch=50):
+    directory = os.path.join(root, f'node{index}')
+    os.makedirs(directory, exist_ok=True)
+    addresses = [f'127.0.0.1:{port}' for port in PORTS]
+    with open(os.path.join(directory, 'piebus.conf'), 'w') as f:
+        f.write('[cluster]\n'
+                f'self = {addresses[index]}\n'
+                f'partners = {", ".join(a for a in addresses if a != addresses[index])}\n'
+                f'compaction_entries = {100 if compaction else 10 ** 9}\n'
+                f'compaction_seconds = {5 if compaction else 10 ** 9}\n')
+    return subprocess.Popen([sys.executable, __file__, '--node', directory,
+                             str(index), str(frames), str(batch), str(int(compaction))],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def frame_count(directory):
+    path = os.path.join(directory, 'piebus.db')
+    if not os.path.exists(path):
+        return 0
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return connection.execute('SELECT count(*) FROM frame').fetchone()[0]
+    except sqlite3.Error:
+        return 0
+    finally:
+        connection.close()
+
+
+def run(compaction, frames, batch):
+    root = tempfile.mkdtemp()
+    writer = start(root, 0, compaction, frames, batch)
+    follower = start(root, 1, compaction)
+    processes = [writer, follower]
+    try:
+        writer.stdout.readline()
+        started = time.perf_counter()
+        processes.append(start(root, 2, compaction))
+        while frame_count(os.path.join(root, 'node2')) < frames:
+            time.sleep(0.05)
+        return time.perf_counter() - started
+    finally:
+        for process in processes:
+            process.kill()
+
+
+def main():
+    if sys.argv[1:2] == ['--node']:
+        return node(sys.argv[2], *[int(arg) for arg in sys.argv[3:7]])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+    for compaction in (False, True):
+        seconds = run(compaction, args.frames, args.batch)
+        print(f'compaction {"on " if compaction else "off"}: new node caught up with '
+              f'{args.frames} frames in {seconds:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Concurrent create_frame throughput with and without group commit.
+
+Without group commit every frame is its own `_create_frames` command,
+so it gets its own transaction, even when the batcher puts several
+commands in one log entry. With group commit, frames created within
+the window are committed as one row list.
+
+    python benchmarks/bench_group_commit.py [--concurrency 64] [--rounds 20] [--window-ms 5]
+
+Runs a single node cluster in this process on a loopback port.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--window-ms', type=int, default=5)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    from piebus.api import Kind, PiebusAPI, ensure_db, frame_row
+    ensure_db()
+    api = PiebusAPI('127.0.0.1:18401', [])
+    api.frame_writer.window = args.window_ms / 1000
+    while not api._getLeader():
+        time.sleep(0.05)
+
+    async def ungrouped(i):
+        row = frame_row(Kind.event, 'telegram-message', data={'message_id': i})
+        return (await api.batcher.run('_create_frames', [row]))[0]
+
+    async def grouped(i):
+        return await api.create_frame(Kind.event, 'telegram-message', data={'message_id': i})
+
+    loop = asyncio.get_event_loop()
+    for name, create in (('ungrouped', ungrouped), ('grouped', grouped)):
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            loop.run_until_complete(asyncio.gather(*[create(i) for i in range(args.concurrency)]))
+        elapsed = time.perf_counter() - started
+        print(f'{name:>10}: {args.rounds * args.concurrency / elapsed:8.0f} frames/s')
+    print('group commit:', api.frame_writer.stats())
+    api.destroy()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Render /live/ with 100 published Telegram frames.
+
+Reports requests/sec for a cold render (fragment and markdown caches
+emptied before every request, so each frame's JSON is decoded and
+rendered again) and a warm one, plus the cost of repeated
+Frame.jdata access with and without the per-instance cache.
+
+    python benchmarks/bench_live.py [--frames 100] [--requests 50]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+MESSAGE = {
+    'message_id': 0,
+    'from': {'id': 1234, 'is_bot': False, 'first_name': 'Owner', 'username': 'owner', 'language_code': 'en'},
+    'chat': {'id': 1234, 'first_name': 'Owner', 'username': 'owner', 'type': 'private'},
+    'date': 1560000000,
+    'text': 'Reading about SQLite WAL mode https://www.sqlite.org/wal.html, **readers** do not block writers.',
+    'entities': [{'offset': 30, 'length': 31, 'type': 'url'}],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('content')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    from piebus import conf
+    from piebus.api import Frame, Kind, ensure_db, frame_row, insert_frames
+    ensure_db()
+    rows = []
+    for i in range(args.frames):
+        data = dict(MESSAGE, message_id=i, text=f'{MESSAGE["text"]} #{i}')
+        rows.append(frame_row(Kind.event, 'telegram-message', data=data, publish=True, render='telegram'))
+    insert_frames(rows)
+
+    frames = list(Frame.select())
+    start = time.perf_counter()
+    for _ in range(10):
+        for frame in frames:
+            json.loads(frame.data)
+    uncached = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(10):
+        for frame in frames:
+            frame.jdata
+    cached = time.perf_counter() - start
+    print(f'jdata x10 per frame: json.loads {uncached * 1000:.2f}ms, cached {cached * 1000:.2f}ms')
+
+    from piebus import server, utils
+    from piebus.cli import configure_app
+    configure_app(server.app)
+    conf['webapp']['live_posts_max'] = str(args.frames)
+    client = server.app.test_client()
+
+    async def get_live():
+        response = await client.get('/live/')
+        if response.status_code != 200:
+            sys.exit(f'/live/ returned {response.status_code}:\n{await response.get_data(raw=False)}')
+
+    async def run(cold):
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            if cold:
+                server.fragment_cache.clear()
+                utils.markdown_cache.clear()
+            await get_live()
+        return args.requests / (time.perf_counter() - start)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(get_live())
+    print(f'/live/ cold: {loop.run_until_complete(run(cold=True)):.1f} req/s')
+    print(f'/live/ warm: {loop.run_until_complete(run(cold=False)):.1f} req/s')
+
+
+if __name__ == '__main__':
+    main()
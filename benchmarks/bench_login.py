@@ -0,0 +1,91 @@
+"""
+Login latency under concurrency, on 1 and 3 node clusters.
+
+Compares the old replicated login, where every attempt is appended to
+the Raft log and checked with bcrypt on every node, with the local
+login that checks the password on the serving node's CPU thread pool.
+The cluster nodes run in this process on loopback ports.
+
+    python benchmarks/bench_login.py [--concurrency 16] [--rounds 5] [--bcrypt-rounds 10]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def measure(login, concurrency, rounds):
+    latencies = []
+
+    async def one():
+        started = time.perf_counter()
+        assert await login('owner', 'secret')
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*[one() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return dict(p50=statistics.median(latencies), p99=percentile(latencies, 0.99),
+                rate=len(latencies) / elapsed)
+
+
+def start_cluster(size, base_port):
+    from pysyncobj import replicated
+    from piebus.api import PiebusAPI, User, check_password
+
+    class LegacyAPI(PiebusAPI):
+        @replicated
+        def _login(self, username, password):
+            user = User.get_or_none(username=username)
+            return bool(user) and check_password(password, user.password)
+
+    addresses = [f'127.0.0.1:{base_port + i}' for i in range(size)]
+    nodes = [LegacyAPI(address, [other for other in addresses if other != address]) for address in addresses]
+    while not all(node._getLeader() for node in nodes):
+        time.sleep(0.05)
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--bcrypt-rounds', type=int, default=10)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    import bcrypt
+    from asgiref.sync import sync_to_async
+    from piebus.api import User, ensure_db, prehash_password
+    ensure_db()
+    hashed = bcrypt.hashpw(prehash_password('secret'), bcrypt.gensalt(args.bcrypt_rounds))
+    User.create(username='owner', password=hashed.decode('utf-8'))
+
+    loop = asyncio.get_event_loop()
+    for size, base_port in ((1, 18100), (3, 18200)):
+        nodes = start_cluster(size, base_port)
+        node = nodes[-1]
+
+        async def replicated_login(username, password):
+            return await sync_to_async(node._login)(username, password, sync=True)
+
+        for name, login in (('replicated', replicated_login), ('local', node.login)):
+            result = loop.run_until_complete(measure(login, args.concurrency, args.rounds))
+            print(f'{size} node(s), {name:>10}: p50 {result["p50"] * 1000:7.1f}ms, '
+                  f'p99 {result["p99"] * 1000:7.1f}ms, {result["rate"]:6.1f} logins/s')
+        for node in nodes:
+            node.destroy()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Markdown rendering throughput for Telegram messages.
+
+Compares a fresh markdown pipeline per call (the old behaviour), the
+reused per-thread engine, and the memoized renderer on a repeated
+corpus, the way /live/ renders the same messages on every view.
+
+    python benchmarks/bench_markdown.py [--corpus export.jsonl] [--rounds 20]
+
+A corpus is a JSONL frame export (see `piebus export`); the `text` of
+telegram-message frames is used. Without one a built-in sample is used.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+SAMPLE = [
+    'Morning run done, 8km along the river https://www.openstreetmap.org/#map=13/18.52/73.85',
+    'Reading about SQLite WAL mode: https://www.sqlite.org/wal.html\nreaders do not block writers.',
+    'Quick note:\n\n* buy coffee\n* fix the bot\n* water plants',
+    '~print("hello from telegram")\n~for i in range(3): print(i)',
+    'New post is up! https://example.com/blog/2019/06/piebus-status check it out &amp; tell me what you think',
+    'Code:\n\n```\ndef add(a, b):\n    return a + b\n```',
+    '**Bold** and _italic_ and `inline code`, plus a [link](https://example.com).',
+    'Long thought: ' + ' '.join(['self-hosting is a garden, not a building.'] * 6),
+    'Sunset from the balcony',
+    '> quote of the day\n> the best code is no code at all',
+]
+
+
+def load_corpus(path):
+    texts = []
+    with open(path) as f:
+        for line in f:
+            frame = json.loads(line)
+            data = frame.get('data') or {}
+            if isinstance(data, str):
+                data = json.loads(data or '{}')
+            if data.get('text'):
+                texts.append(data['text'])
+    return texts
+
+
+def bench(name, render, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in corpus:
+            render(text)
+    elapsed = time.perf_counter() - start
+    renders = rounds * len(corpus)
+    print(f'{name:<24} {renders / elapsed:>10.0f} renders/sec')
+    return renders / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default=None)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    corpus = load_corpus(os.path.abspath(args.corpus)) if args.corpus else SAMPLE
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    import html
+    import markdown
+    from piebus import utils
+
+    def before(text):
+        text = html.unescape(text)
+        import re
+        text = re.sub(r'(https?:[^\s\n\r]+)', r'<a href="\1">\1</a>', text)
+        md = utils.tg_tilde.sub(r'```\1', text)
+        return markdown.markdown(md, extensions=utils.MARKDOWN_EXTENSIONS)
+
+    def reused(text):
+        return utils.telegram_markdown.__wrapped__(text)
+
+    print(f'{len(corpus)} messages x {args.rounds} rounds')
+    baseline = bench('fresh pipeline (before)', before, corpus, args.rounds)
+    bench('reused engine', reused, corpus, args.rounds)
+    after = bench('reused + memoized', utils.telegram_markdown, corpus, args.rounds)
+    print(f'speedup: {after / baseline:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
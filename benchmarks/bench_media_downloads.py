@@ -0,0 +1,131 @@
+"""
+Telegram media handling against a local stand-in for the Bot API file
+endpoints (getFile and /file/bot<token>/<path>), which serves files at
+a fixed bandwidth, fails some requests once and has one oversized file.
+
+Compares downloading inline in the message handler, as the bot used to,
+with queueing the download and acknowledging straight away.
+
+    python benchmarks/bench_media_downloads.py [--messages 40] [--size-kb 512] [--kbps 4096]
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = '123:TEST'
+
+
+def stand_in(size, kbps, flaky, oversized):
+    failed = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == f'/bot{TOKEN}/getFile':
+                file_id = parse_qs(url.query)['file_id'][0]
+                body = json.dumps(dict(ok=True, result=dict(file_id=file_id, file_path=f'photos/{file_id}.jpg')))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode())
+                return
+            file_id = url.path.rsplit('/', 1)[-1][:-4]
+            if file_id in flaky and file_id not in failed:
+                failed.add(file_id)
+                self.send_response(503)
+                self.end_headers()
+                return
+            length = size * 8 if file_id in oversized else size
+            self.send_response(200)
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            chunk = 64 * 1024
+            try:
+                for start in range(0, length, chunk):
+                    self.wfile.write(b'x' * min(chunk, length - start))
+                    time.sleep(chunk / (kbps * 1024))
+            except ConnectionError:
+                pass  # the client gave up on an oversized file
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=40)
+    parser.add_argument('--size-kb', type=int, default=512)
+    parser.add_argument('--kbps', type=int, default=4096)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir('content')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    from piebus import conf
+    from piebus.downloads import MediaDownloads
+
+    size = args.size_kb * 1024
+    section = configparser.ConfigParser()
+    section.read_dict({'downloads': dict(conf['downloads'], retry_backoff='0.05', max_mb_photo=str(size * 4 / 2 ** 20))})
+    photos = [dict(file_id=f'f{i}') for i in range(args.messages)]
+    loop = asyncio.get_event_loop()
+
+    async def inline(api_base):
+        downloads = MediaDownloads(section['downloads'], api_base, TOKEN, 'content')
+        downloads.start()
+        acks = []
+        for photo in photos:
+            started = time.perf_counter()
+            try:
+                await downloads.download('photo', photo)
+            except Exception:
+                pass
+            acks.append(time.perf_counter() - started)
+        await downloads.stop()
+        return acks, downloads.stats()
+
+    async def queued(api_base):
+        downloads = MediaDownloads(section['downloads'], api_base, TOKEN, 'content')
+        done = []
+
+        async def on_done(uuid, filename):
+            done.append(filename)
+
+        acks = []
+        for i, photo in enumerate(photos):
+            started = time.perf_counter()
+            downloads.submit(f'frame{i}', 'photo', photo, on_done)
+            acks.append(time.perf_counter() - started)
+        while downloads.stats()['pending'] or downloads.stats()['active'] or \
+                len(done) + downloads.counters['too_large'] + downloads.counters['failed'] < len(photos):
+            await asyncio.sleep(0.01)
+        await downloads.stop()
+        return acks, downloads.stats()
+
+    for name, run in (('inline', inline), ('queued', queued)):
+        server = stand_in(size, args.kbps, flaky={'f3', 'f7'}, oversized={'f5'})
+        started = time.perf_counter()
+        acks, stats = loop.run_until_complete(run(f'http://127.0.0.1:{server.server_port}'))
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+        # messages arrive together, each waits for the ones handled before it
+        print(f'{name:>7}: last message handled after {sum(acks):.3f}s, '
+              f'all media in place after {elapsed:.2f}s')
+        print(f'         {stats}')
+    partial = [name for name in os.listdir('content') if name.endswith('.part')]
+    print(f'{len(os.listdir("content"))} files in content/, {len(partial)} partial')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+SQLite read/write throughput across pragma profiles.
+
+Each profile gets a fresh database in a temp directory, filled with
+Telegram-like frames one transaction per frame (as create_frame does),
+then in batches (as `piebus import` does), followed by uuid lookups and
+published-frame page reads.
+
+    python benchmarks/bench_sqlite_pragmas.py [--frames 2000] [--reads 5000]
+
+`tuned` is the [database] default in piebus.conf.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+PROFILES = {
+    'sqlite-default': dict(journal_mode='delete', synchronous='full'),
+    'wal-32mb': dict(journal_mode='wal', cache_size='-32768'),
+    'tuned-no-mmap': dict(journal_mode='wal', synchronous='normal', cache_size='-32768',
+                          temp_store='memory', busy_timeout='5000', wal_autocheckpoint='1000'),
+    'tuned': dict(journal_mode='wal', synchronous='normal', cache_size='-32768', mmap_size='268435456',
+                  temp_store='memory', busy_timeout='5000', wal_autocheckpoint='1000'),
+}
+
+
+def message(i):
+    return {
+        'message_id': i,
+        'from': {'id': 1234, 'is_bot': False, 'first_name': 'Owner', 'username': 'owner'},
+        'chat': {'id': 1234, 'first_name': 'Owner', 'username': 'owner', 'type': 'private'},
+        'date': 1560000000 + i,
+        'text': f'Message {i}: reading about SQLite WAL mode, readers do not block writers. ' * 3,
+    }
+
+
+def rate(count, started):
+    return count / (time.perf_counter() - started)
+
+
+def bench(name, pragmas, frames, reads):
+    from peewee import chunked
+    from playhouse.sqlite_ext import SqliteExtDatabase
+    from piebus.api import Frame, Kind, database_pragmas, frame_row, page_query
+
+    path = os.path.join(tempfile.mkdtemp(), f'{name}.db')
+    database = SqliteExtDatabase(path, pragmas=database_pragmas(pragmas))
+    results = {}
+    with database.bind_ctx([Frame]):
+        database.create_tables([Frame])
+        rows = [frame_row(Kind.event, 'telegram-message', data=message(i), publish=i % 2, render='telegram')
+                for i in range(frames * 2)]
+
+        started = time.perf_counter()
+        for row in rows[:frames]:
+            with database.atomic():
+                Frame.insert(row).execute()
+        results['single writes/s'] = rate(frames, started)
+
+        started = time.perf_counter()
+        with database.atomic():
+            for batch in chunked(rows[frames:], 100):
+                Frame.insert_many(batch).execute()
+        results['batch writes/s'] = rate(frames, started)
+
+        uuids = [row['uuid'] for row in rows]
+        started = time.perf_counter()
+        for _ in range(reads):
+            Frame.get(Frame.uuid == random.choice(uuids)).jdata
+        results['uuid reads/s'] = rate(reads, started)
+
+        published = Frame.select().where(Frame.publish == True)
+        started = time.perf_counter()
+        for _ in range(reads // 10):
+            [frame.jdata for frame in page_query(published, 20)]
+        results['page reads/s'] = rate(reads // 10, started)
+    database.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--reads', type=int, default=5000)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    for name, pragmas in PROFILES.items():
+        results = bench(name, pragmas, args.frames, args.reads)
+        print(f'{name:>16}: ' + ', '.join(f'{value:8.0f} {key}' for key, value in results.items()))
+
+
+if __name__ == '__main__':
+    main()
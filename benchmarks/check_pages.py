@@ -0,0 +1,65 @@
+"""
+Smoke check of the pages that render frames.
+
+Starts the app on a fresh project with one user, a public and a private
+frame, then GETs /live/, /frames/, /frame/<uuid>/ and /search/ through
+Quart's test client, anonymous and logged in. Any unexpected status
+makes the script exit non-zero.
+
+    python benchmarks/check_pages.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('content')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    from piebus.api import Kind
+    from piebus.cli import configure_app
+    from piebus.indexer import index_queue
+    from piebus.server import api, app
+    configure_app(app, register=True)
+    client = app.test_client()
+    failures = []
+
+    async def check(path, status=200, text=None):
+        response = await client.get(path)
+        body = await response.get_data(raw=False)
+        ok = response.status_code == status and (text is None or text in body)
+        print(f'{"ok  " if ok else "FAIL"} {response.status_code} {path}')
+        if not ok:
+            failures.append(path)
+
+    async def run():
+        await app.startup()
+        while not api._getLeader():
+            await asyncio.sleep(0.05)
+        public = await api.create_frame(Kind.event, 'telegram-message', data={'text': 'hello public'},
+                                        publish=True, render='telegram')
+        private = await api.create_frame(Kind.event, 'telegram-message', data={'text': 'hello private'},
+                                         render='telegram')
+        # the search index is written behind, don't race its next flush
+        index_queue.flush()
+        await check('/live/', text='hello public')
+        await check(f'/frame/{public.uuid}/', text='hello public')
+        await check('/search/?q=hello', text='hello public')
+        await check('/frames/', status=302)
+        await client.post('/register/', form=dict(username='owner', password='secret'))
+        await check('/live/', text='hello public')
+        await check('/frames/', text='hello private')
+        await check(f'/frame/{private.uuid}/', text='hello private')
+        await check('/search/?q=hello', text='hello private')
+        await app.shutdown()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    api.destroy()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
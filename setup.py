@@ -10,6 +10,7 @@ from setuptools import (
 )
 
 extras_telegram = ['aiogram==2.1']
+extras_speedups = ['orjson', 'msgpack', 'zstandard']
 
 
 setup(
@@ -42,6 +43,7 @@ setup(
 
     extras_require={
         'telegram': extras_telegram,
+        'speedups': extras_speedups,
     },
 
     entry_points={
@@ -23,18 +23,82 @@ conf['paths']['static'] = '${package}/static'
 conf['paths']['projects'] = '${package}/projects'
 conf['paths']['package'] = os.path.dirname(os.path.abspath(__file__))
 
+conf['database'] = {}
+conf['database']['codec'] = 'json'
+conf['database']['journal_mode'] = 'wal'
+conf['database']['synchronous'] = 'normal'
+conf['database']['cache_size'] = '-32768'
+conf['database']['mmap_size'] = '268435456'
+conf['database']['temp_store'] = 'memory'
+conf['database']['busy_timeout'] = '5000'
+conf['database']['wal_autocheckpoint'] = '1000'
+conf['database']['group_commit_ms'] = '5'
+conf['database']['group_commit_max'] = '200'
+
+conf['cluster'] = {}
+conf['cluster']['self'] = '127.0.0.1:8008'
+conf['cluster']['partners'] = ''
+conf['cluster']['bind'] = ''
+conf['cluster']['batch_max'] = '64'
+conf['cluster']['read_your_writes'] = 'yes'
+conf['cluster']['read_your_writes_timeout'] = '2'
+conf['cluster']['dynamic_membership'] = 'no'
+conf['cluster']['snapshot'] = 'piebus.snapshot'
+conf['cluster']['compaction_entries'] = '5000'
+conf['cluster']['compaction_seconds'] = '3600'
+conf['cluster']['backup_pages'] = '4096'
+conf['cluster']['transfer_chunk_kb'] = '64'
+
+conf['maintenance'] = {}
+conf['maintenance']['enabled'] = 'yes'
+conf['maintenance']['idle_seconds'] = '60'
+conf['maintenance']['check_interval'] = '15'
+conf['maintenance']['wal_max_mb'] = '64'
+conf['maintenance']['checkpoint_interval'] = '300'
+conf['maintenance']['optimize_interval'] = '3600'
+conf['maintenance']['analyze_interval'] = '86400'
+conf['maintenance']['fts_optimize_interval'] = '86400'
+conf['maintenance']['vacuum'] = 'no'
+conf['maintenance']['vacuum_free_ratio'] = '0.25'
+
 conf['webapp'] = {}
 conf['webapp']['name'] = 'piebus'
 conf['webapp']['register'] = 'no'
 conf['webapp']['secret_key'] = uuid4().hex
 conf['webapp']['live_posts_max'] = '20'
+conf['webapp']['search_results_max'] = '200'
+conf['webapp']['sse_queue_size'] = '16'
+conf['webapp']['sse_keepalive'] = '30'
+conf['webapp']['fragment_cache_size'] = '2048'
 # conf['webapp']['live_posts_max_age'] = '1 week'
 # conf['webapp']['live_posts_per_page'] = 10
+conf['media'] = {}
+conf['media']['resize_widths'] = '140,200,300,400,500,700,900,1200'
+conf['media']['resize_cache'] = '${paths:content}/.resized'
+conf['media']['resize_cache_max_mb'] = '256'
+conf['media']['resize_max_age'] = '604800'
+conf['workers'] = {}
+conf['workers']['media_processes'] = '2'
+conf['workers']['media_queue_max'] = '16'
+conf['workers']['retry_after'] = '5'
+conf['workers']['db_readers'] = '4'
+conf['workers']['cpu_threads'] = '4'
 conf['telegram-bot'] = {}
 conf['telegram-bot']['name'] = ''
 conf['telegram-bot']['token'] = ''
 conf['telegram-bot']['owner'] = ''
 conf['telegram-bot']['owner_id'] = ''
+conf['telegram-bot']['file_api'] = 'https://api.telegram.org'
+conf['downloads'] = {}
+conf['downloads']['concurrency'] = '4'
+conf['downloads']['queue_max'] = '256'
+conf['downloads']['retries'] = '3'
+conf['downloads']['retry_backoff'] = '2'
+conf['downloads']['timeout'] = '300'
+conf['downloads']['chunk_kb'] = '64'
+conf['downloads']['max_mb'] = '20'
+conf['downloads']['max_mb_photo'] = '10'
+conf['downloads']['max_mb_sticker'] = '1'
 
 if not os.path.exists('piebus.conf'):
     iofile = io.StringIO()
@@ -1,7 +1,4 @@
 import asyncio
-import os
-
-from uuid import uuid4
 
 from aiogram import Bot, Dispatcher, executor, types, filters
 from aiogram.types import ReplyKeyboardRemove
@@ -11,8 +8,11 @@ from asgiref.sync import sync_to_async
 from piebus import conf
 
 from piebus.api import Kind
+from piebus.cluster import ReplicationError
+from piebus.downloads import media_downloads, media_file
+from piebus.workers import WorkerPoolBusy
 
-from piebus.server import api, content_path, render
+from piebus.server import api, render
 from quart import url_for
 
 BOT_NAME = conf['telegram-bot']['name']
@@ -25,10 +25,6 @@ bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(bot)
 
 
-def mkfilename(prefix, suffix):
-    return content_path(f'{prefix}{uuid4().hex}.{suffix}')
-
-
 @dp.message_handler(filters.CommandStart())
 async def send_welcome(message: types.Message):
     print('handling /start annd /help commands', message.text)
@@ -36,27 +32,28 @@ async def send_welcome(message: types.Message):
     await message.reply(f"Hi!\nI'm {BOT_NAME}!\n")
 
 
+async def fetch_map(frame):
+    try:
+        await api.fetch_map(frame)
+    except (WorkerPoolBusy, ReplicationError) as e:
+        print('map rendering skipped:', e)
+
+
 @dp.message_handler(content_types=ContentType.ANY)
 async def messages(message: types.Message):
     data = dict(message)
-    path = None
-    if message.photo:
-        path = await message.photo[-1].download(mkfilename('img_', 'jpg'))
-    elif message.voice:
-        path = await message.voice.download(mkfilename('voi_', 'oga'))
-    elif message.video_note:
-        path = await message.video_note.download(mkfilename('vin_', 'mp4'))
-    elif message.video:
-        path = await message.video.download(mkfilename('vid_', 'mp4'))
-    elif message.sticker:
-        path = await message.sticker.thumb.download(mkfilename('stk_', 'webp'))
-    else:
-        print('unknown media:', message)
-    if path:
-        data.update({'media_url': path.name})
+    kind, media = media_file(data)
     frame = await api.create_frame(Kind.event, 'telegram-message', data=data, render='telegram')
+    if kind:
+        try:
+            media_downloads.submit(frame.uuid, kind, media, api.set_frame_media)
+        except WorkerPoolBusy as e:
+            print('media download skipped:', e)
+    elif not message.text and 'location' not in data:
+        print('unknown media:', message)
     if 'location' in data:
-        await sync_to_async(frame.fetch_map)()
+        # rendering and replicating the map would hold up the updates behind this one
+        asyncio.ensure_future(fetch_map(frame))
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton('Public', callback_data=f'frame public {frame.uuid}'))
     markup.add(types.InlineKeyboardButton('Private', callback_data=f'frame private {frame.uuid}'))
@@ -2,16 +2,16 @@ import asyncio
 import base64
 import datetime
 import hashlib
-import json
+import html
 import os
-import smopy
+import threading
+import time
 import traceback
-from json import JSONDecodeError
+from collections import namedtuple
 from uuid import uuid4
 
 import bcrypt
 import peewee
-from PIL import Image, ImageDraw
 from peewee import (
     Model,
     CharField,
@@ -21,25 +21,42 @@ from peewee import (
     DateTimeField,
     BooleanField,
 )
+from peewee import chunked, fn
 from playhouse.sqlite_ext import (
     SqliteExtDatabase,
-    FTSModel)
-from pysyncobj import SyncObj, replicated
-from asgiref.sync import sync_to_async
-
-from . import PATH_DATABASE
+    FTS5Model,
+    SearchField)
+from pysyncobj import FAIL_REASON, SyncObj, replicated
+
+from . import PATH_DATABASE, conf
+from .cache import LRUCache
+from .cluster import CommandBatcher, ReplicationError
+from .codec import decode_payload, encode_payload, json_dumps, json_loads, payload_codec
+from .media import render_location_map
+from .pipeline import GroupCommit
+from .workers import cpu_threads, db_readers, media_pool
 
 loop = asyncio.get_event_loop()
 
-pragmas = [
-    ('journal_mode', 'wal'),
-    ('cache_size', -1024 * 32)]
+PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+           'temp_store', 'busy_timeout', 'wal_autocheckpoint')
+
+
+def database_pragmas(section):
+    """
+    Pragmas from a [database] config section, applied by peewee to every
+    new connection; empty values keep SQLite's default.
+    """
+    return [(name, section[name]) for name in PRAGMAS if section.get(name)]
+
+
+db = SqliteExtDatabase(PATH_DATABASE, pragmas=database_pragmas(conf['database']))
 
-db = SqliteExtDatabase(PATH_DATABASE, pragmas=pragmas)
+STORAGE_CODEC = payload_codec(conf['database']['codec'])
 
 
 class BaseModel(Model):
-    timestamp = DateTimeField(default=datetime.datetime.utcnow, index=True)
+    timestamp = DateTimeField(default=datetime.datetime.utcnow)
 
     class Meta:
         database = db
@@ -48,7 +65,7 @@ class BaseModel(Model):
 class User(BaseModel):
     username = CharField(index=True, unique=True)
     password = CharField(index=False)
-    note = TextField(index=True, default='')
+    note = TextField(default='')
 
 
 class Preference(BaseModel):
@@ -56,100 +73,162 @@ class Preference(BaseModel):
     value = CharField(index=False)
 
 
+class PayloadField(TextField):
+    """
+    JSON text on the Python side, stored as text or as a tagged binary
+    blob depending on the database codec; both read back the same.
+    """
+
+    def db_value(self, value):
+        if value is None or isinstance(value, bytes):
+            return value
+        return encode_payload(str(value), STORAGE_CODEC)
+
+    def python_value(self, value):
+        return decode_payload(value)
+
+
 class Frame(BaseModel):
     # Zentropi fields:
     uuid = CharField(index=True, unique=True)
     kind = IntegerField(index=True)
-    name = TextField(index=True)
-    data = TextField(default='')
-    meta = TextField(default='')
+    name = TextField()
+    data = PayloadField(default='')
+    meta = PayloadField(default='')
     # piebus fields:
-    publish = BooleanField(default=False, index=True)
-    render = CharField(index=True, default='default')
+    publish = BooleanField(default=False)
+    render = CharField(default='default')
     source = CharField(default='')
-    tags = TextField(index=True, default='')
+    tags = TextField(default='')
+    # promoted from data at write time, see promoted_fields():
+    chat_id = IntegerField(null=True)
+    from_id = IntegerField(null=True)
+    media_url = CharField(default='')
+    has_location = BooleanField(default=False)
+    content_type = CharField(default='')
+
+    class Meta:
+        indexes = (
+            (('timestamp', 'id'), False),
+            (('publish', 'timestamp', 'id'), False),
+            (('chat_id', 'timestamp', 'id'), False),
+            (('from_id', 'timestamp', 'id'), False),
+            (('content_type', 'timestamp', 'id'), False),
+            (('has_location', 'timestamp', 'id'), False),
+        )
 
     @property
-    def jdata(self):
+    def revision(self):
+        return hash((self.name, self.data, self.meta, self.publish, self.render, self.tags))
+
+    def _decoded(self, field):
+        """
+        Decoded JSON of a text field, cached on the instance for as long
+        as the field still holds the same string object, so assigning a
+        new value invalidates it.
+        """
+        raw = self.__data__.get(field)
+        cache = self.__dict__.setdefault('_json_cache', {})
+        cached = cache.get(field)
+        if cached is not None and cached[0] is raw:
+            return cached[1]
+        value = {}
         try:
-            if self.data:
-                return dict(json.loads(self.data) or {})
-        except JSONDecodeError:
-            print('cannot decode data', self.data)
-            pass
-        return {}
+            if raw:
+                value = dict(json_loads(raw) or {})
+        except (TypeError, ValueError):
+            print(f'cannot decode {field}', raw)
+        cache[field] = (raw, value)
+        return value
+
+    @property
+    def jdata(self):
+        return self._decoded('data')
 
     @property
     def jmeta(self):
-        try:
-            if self.meta:
-                return dict(json.loads(self.meta) or {})
-        except JSONDecodeError:
-            print('cannot decode meta', self.meta)
-            pass
-        return {}
+        return self._decoded('meta')
+
+    def promote(self):
+        for field, value in promoted_fields(self.jdata).items():
+            setattr(self, field, value)
 
-    async def fetch_map_async(self):
-        tsurl = """http://c.tile.stamen.com/watercolor/${z}/${x}/${y}.jpg"""
+    def _location(self):
         data = self.jdata
-        if 'location' in data:
-            lat = data['location'].get('latitude')
-            lon = data['location'].get('longitude')
-            map = await sync_to_async(smopy.Map)((lat - 1, lat + 1., lon - 1, lon + 1), z=4)
-            await sync_to_async(map.save_png)(f'map_{self.uuid}.png', tileserver=tsurl)
-        else:
+        if 'location' not in data:
             raise KeyError(f'No location data found in frame: {self}')
+        return data, data['location'].get('latitude'), data['location'].get('longitude')
+
+    def _set_media_url(self, data, path):
+        data.update({'media_url': path})
+        self.data = json_dumps(data)
+        self.promote()
+        self.save()
+        return os.path.basename(path)
 
     def fetch_map(self):
-        data = self.jdata
-        if 'location' in data:
-            lat = data['location'].get('latitude')
-            lon = data['location'].get('longitude')
-            map = smopy.Map((lat - 0.006, lon - 0.038, lat + 0.006, lon + 0.038), z=12,
-                            tileserver="http://tile.basemaps.cartocdn.com/light_all/{z}/{x}/{y}@2x.png",
-                            tilesize=512, maxtiles=16)
-            x, y = map.to_pixels(lat, lon)
-            x = int(x)
-            y = int(y)
-            fname = f'map_{self.uuid}.png'
-            map.save_png(f'content/{fname}')
-            img = Image.open(open(f'content/{fname}', 'rb'))
-            draw = ImageDraw.Draw(img)
-            draw.ellipse([(x-10, y-10), (x+10, y+10)], fill=128,  width=10)
-            del draw
-            ffname = f'content/loc_{fname}'
-            img.save(ffname, "PNG")
-            data.update({'media_url': ffname})
-            self.data = json.dumps(data)
-            self.save()
-            return f'loc_{fname}'
-        else:
-            raise KeyError(f'No location data found in frame: {self}')
+        data, lat, lon = self._location()
+        path = render_location_map(lat, lon, 'content', f'map_{self.uuid}.png')
+        return self._set_media_url(data, path)
+
+
+CONTENT_TYPES = ('photo', 'video', 'video_note', 'voice', 'audio', 'animation', 'sticker',
+                 'document', 'location', 'venue', 'contact', 'poll', 'text')
 
 
-class FTSEntry(FTSModel):
-    content = TextField()
+def _nested_id(data, key):
+    value = data.get(key)
+    return value.get('id') if isinstance(value, dict) else None
+
+
+def promoted_fields(data):
+    """
+    Columns copied out of a frame's data when it is written, so listings
+    can filter on them through an index instead of decoding every row.
+    Field names follow Telegram messages.
+    """
+    if not isinstance(data, dict):
+        data = {}
+    return dict(
+        chat_id=_nested_id(data, 'chat'),
+        from_id=_nested_id(data, 'from'),
+        media_url=str(data.get('media_url') or ''),
+        has_location='location' in data,
+        content_type=next((key for key in CONTENT_TYPES if data.get(key)), ''),
+    )
+
+
+def plain_text(value):
+    """
+    Message text as a string. Telegram Desktop exports write formatted
+    text as a list of strings and {"type": ..., "text": ...} entities.
+    """
+    if isinstance(value, list):
+        return ''.join(part.get('text', '') if isinstance(part, dict) else str(part) for part in value)
+    return value if isinstance(value, str) else ''
+
+
+class FTSEntry(FTS5Model):
+    content = SearchField()
 
     class Meta:
         database = db
+        options = {'tokenize': 'porter unicode61'}
+
+    @staticmethod
+    def frame_content(frame: Frame):
+        if frame.name == 'telegram-message':
+            data = frame.jdata
+            return '\n'.join([plain_text(data.get('text')), plain_text(data.get('caption')), frame.tags])
+        return '\n'.join([frame.name, str(frame.data), frame.tags])
 
     @classmethod
     def index_frame(cls, frame: Frame):
-        try:
-            existing = cls.get_or_none(docid=frame.id)
-            if frame.name == 'telegram-message':
-                content = '\n'.join([frame.jdata.get('text', ''), frame.jdata.get('caption', ''), frame.tags])
-            else:
-                content = '\n'.join([frame.name, str(frame.data), frame.tags])
-            if not content.strip():
-                return
-            if existing:
-                existing.update(content=content)
-            else:
-                cls.create(docid=frame.id, content=content)
-        except peewee.OperationalError:
-            cls.create_table()
-            cls.index_frame(frame)
+        content = cls.frame_content(frame)
+        if not content.strip():
+            cls.delete().where(cls.rowid == frame.id).execute()
+            return
+        cls.insert({cls.rowid: frame.id, cls.content: content}).on_conflict_replace().execute()
 
 
 class Kind(object):
@@ -162,146 +241,577 @@ class Kind(object):
     stream = 6
 
 
+# bump together with piebus.migrations.MIGRATIONS
+SCHEMA_VERSION = 5
+
+
 def ensure_db():
-    if os.path.exists(PATH_DATABASE):
+    # check for the tables, not the file: anything that opened the
+    # database before us has already created an empty one
+    if User.table_exists():
         return False
     User.create_table()
     Preference.create_table()
     Frame.create_table()
+    FTSEntry.create_table()
+    db.pragma('user_version', SCHEMA_VERSION)
     return True
 
 
-class PiebusAPI(SyncObj):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+def ensure_search_index():
+    table = FTSEntry._meta.table_name
+    row = db.execute_sql("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+    if row and 'fts5' in row[0].lower():
+        return False
+    if row:
+        FTSEntry.drop_table()
+    FTSEntry.create_table()
+    Preference.delete().where(Preference.key == 'fts_high_water_mark').execute()
+    return True
 
-    @replicated
-    def _register(self, username, password):
-        password = base64.b64encode(hashlib.sha256(password.encode('utf-8')).digest())
-        hashed = bcrypt.hashpw(password, bcrypt.gensalt())
+
+def backfill_promoted_fields(batch_size=500):
+    last_id = 0
+    count = 0
+    while True:
+        frames = list(Frame.select().where(Frame.id > last_id).order_by(Frame.id).limit(batch_size))
+        if not frames:
+            return count
+        with db.atomic():
+            for frame in frames:
+                fields = promoted_fields(frame.jdata)
+                if any(getattr(frame, field) != value for field, value in fields.items()):
+                    Frame.update(fields).where(Frame.id == frame.id).execute()
+                    count += 1
+        last_id = frames[-1].id
+
+
+def frame_row(kind, name, data=None, meta=None, publish=False, render='', tags='',
+              source=None, uuid=None, timestamp=None):
+    """
+    Column values for a new frame. uuid and timestamp are fixed here, by
+    the caller, so every node applying the replicated insert stores the
+    same frame.
+    """
+    if source is None:
+        source = meta.get('source', '') if isinstance(meta, dict) else ''
+    return dict(
+        promoted_fields(data),
+        uuid=uuid or uuid4().hex,
+        timestamp=timestamp or datetime.datetime.utcnow(),
+        kind=int(kind) if kind != '' else 1,
+        name=name,
+        data=json_dumps(data) or '',
+        meta=json_dumps(meta) or '',
+        publish=bool(publish),
+        render=render or 'default',
+        source=source or '',
+        tags=tags or '',
+    )
+
+
+def insert_frames(rows):
+    with db.atomic():
+        for batch in chunked(rows, 50):
+            Frame.insert_many(batch).on_conflict_ignore().execute()
+    uuids = [row['uuid'] for row in rows]
+    frames = {}
+    for batch in chunked(uuids, 500):
+        frames.update((frame.uuid, frame) for frame in Frame.select().where(Frame.uuid.in_(batch)))
+    return [frames[uuid] for uuid in uuids]
+
+
+def filter_query(query, chat_id=None, from_id=None, content_type=None, has_location=None):
+    if chat_id is not None:
+        query = query.where(Frame.chat_id == chat_id)
+    if from_id is not None:
+        query = query.where(Frame.from_id == from_id)
+    if content_type:
+        query = query.where(Frame.content_type == content_type)
+    if has_location is not None:
+        query = query.where(Frame.has_location == has_location)
+    return query
+
+
+def recode_frames(codec, batch_size=500, dry_run=False, progress=None):
+    """
+    Rewrite stored frame payloads with `codec`, in batched transactions.
+    Returns bytes before and after, and how fast payloads were decoded
+    (to JSON objects) before and after.
+    """
+    codec = payload_codec(codec)
+    table = Frame._meta.table_name
+    stats = dict(frames=0, changed=0, bytes_before=0, bytes_after=0,
+                 decode_before=0.0, decode_after=0.0)
+    last_id = 0
+    while True:
+        rows = db.execute_sql(f'SELECT id, data, meta FROM "{table}" WHERE id > ? ORDER BY id LIMIT ?',
+                              (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for frame_id, *old in rows:
+            texts = [decode_payload(value) for value in old]
+            new = [encode_payload(text, codec) for text in texts]
+            stats['decode_before'] += decode_seconds(old)
+            stats['decode_after'] += decode_seconds(new)
+            stats['bytes_before'] += sum(payload_size(value) for value in old)
+            stats['bytes_after'] += sum(payload_size(value) for value in new)
+            if new != old:
+                updates.append((*new, frame_id))
+        if updates and not dry_run:
+            with db.atomic():
+                db.cursor().executemany(f'UPDATE "{table}" SET data = ?, meta = ? WHERE id = ?', updates)
+        stats['frames'] += len(rows)
+        stats['changed'] += len(updates)
+        last_id = rows[-1][0]
+        if progress:
+            progress(stats)
+    return stats
+
+
+def decode_seconds(values):
+    started = time.perf_counter()
+    for value in values:
+        if value:
+            json_loads(decode_payload(value))
+    return time.perf_counter() - started
+
+
+def payload_size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return len(value) if value else 0
+
+
+Page = namedtuple('Page', ['frames', 'next'])
+
+
+def encode_cursor(frame):
+    token = f'{frame.timestamp.isoformat()}|{frame.id}'
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        token = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, frame_id = token.split('|')
+        return datetime.datetime.fromisoformat(timestamp), int(frame_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+
+
+def page_query(query, limit, before=None):
+    if before:
+        timestamp, frame_id = decode_cursor(before)
+        query = query.where(
+            (Frame.timestamp <= timestamp) &
+            ((Frame.timestamp < timestamp) | (Frame.id < frame_id)))
+    return query.order_by(Frame.timestamp.desc(), Frame.id.desc()).limit(limit + 1)
+
+
+def paginate(query, limit, before=None):
+    """
+    Keyset pagination over (timestamp, id), newest first.
+
+    `before` is the cursor returned with the previous page; the seek on
+    the (timestamp, id) index keeps every page O(limit) however deep it is.
+    """
+    frames = list(page_query(query, limit, before))
+    if len(frames) > limit:
+        return Page(frames[:limit], encode_cursor(frames[limit - 1]))
+    return Page(frames, None)
+
+
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+search_cache = LRUCache(maxsize=256)
+
+
+def highlight_snippet(snippet):
+    snippet = html.escape(snippet or '')
+    return snippet.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+def search_query(query, public, offset, limit):
+    table = FTSEntry._meta.entity
+    snippet = fn.snippet(table, 0, SNIPPET_START, SNIPPET_END, '...', 24)
+    frames = Frame \
+        .select(Frame, snippet.alias('snippet')) \
+        .join(FTSEntry, on=(Frame.id == FTSEntry.rowid)) \
+        .where(FTSEntry.match(query))
+    if public:
+        frames = frames.where(Frame.publish == True)
+    return frames \
+        .order_by(fn.bm25(table), Frame.id.desc()) \
+        .offset(offset) \
+        .limit(limit) \
+        .objects()
+
+
+def search(query, public, page=1, per_page=10):
+    """
+    Rank matches with bm25 and return one page of at most `per_page`
+    frames, each with a highlighted `snippet`; nothing past
+    `search_results_max` is ever returned.
+    """
+    key = (query, public, page, per_page)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    max_results = int(conf['webapp']['search_results_max'])
+    offset = (page - 1) * per_page
+    limit = min(per_page, max_results - offset)
+    if limit <= 0:
+        return Page([], None)
+    frames = search_query(query, public, offset, limit + 1)
+    try:
+        frames = list(frames)
+    except peewee.OperationalError:
+        frames = []
+    for frame in frames:
+        frame.snippet = highlight_snippet(frame.snippet)
+    if len(frames) > limit:
+        return search_cache.set(key, Page(frames[:limit], page + 1))
+    return search_cache.set(key, Page(frames, None))
+
+
+def prehash_password(password):
+    return base64.b64encode(hashlib.sha256(password.encode('utf-8')).digest())
+
+
+def hash_password(password):
+    return bcrypt.hashpw(prehash_password(password), bcrypt.gensalt()).decode('utf-8')
+
+
+def check_password(password, hashed):
+    return bcrypt.checkpw(prehash_password(password), hashed.encode('utf-8'))
+
+
+class PreferenceCache(object):
+    """
+    In-process copy of the preference table.
+
+    Loaded once, then kept current by write-through from the replicated
+    `_set_preference`, so reads are dictionary lookups. JSON values are
+    decoded once and the decoded object is shared, callers must not
+    mutate it.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._decoded = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        # read under the lock too, so a set() racing with the reload
+        # lands in the new dict instead of the discarded one
+        with self._lock:
+            values = {pref.key: pref.value for pref in Preference.select()}
+            self._values = values
+            self._decoded = {}
+        return values
+
+    @property
+    def values(self):
+        if self._values is None:
+            self.load()
+        return self._values
+
+    def get(self, key, default=None):
+        value = self.values.get(key)
+        return value if value is not None else default
+
+    def get_bool(self, key, default=False):
+        value = self.get(key)
+        return bool(int(value)) if value is not None else default
+
+    def get_json(self, key, default=None):
         try:
-            User.create(username=username, password=hashed)
-            return True
-        except:
-            traceback.print_exc()
-            return False
+            return self._decoded[key]
+        except KeyError:
+            pass
+        if self._values is None:
+            self.load()
+        # decode and store together, or a set() in between would have its
+        # value replaced by the decoded old one
+        with self._lock:
+            if key not in self._decoded:
+                value = self._values.get(key)
+                self._decoded[key] = json_loads(value) if value else default
+            return self._decoded[key]
+
+    def set(self, key, value):
+        value = Preference.value.db_value(value)
+        # load() takes the lock, which is not reentrant, so the first
+        # load has to happen before we take it
+        if self._values is None:
+            self.load()
+        with self._lock:
+            self._values[key] = value
+            self._decoded.pop(key, None)
+        return value
 
-    async def register(self, username, password):
-        return await sync_to_async(self._register)(username, password, sync=True)
 
-    @replicated
-    def _login(self, username, password):
-        user = User.get_or_none(username=username)
-        if not user:
-            return False
-        password = base64.b64encode(hashlib.sha256(password.encode('utf-8')).digest())
-        hashed = user.password.encode('utf-8')
-        if bcrypt.checkpw(password, hashed):
-            return True
-        return False
+BATCHED_COMMANDS = {'_register', '_set_preference', '_create_frames', '_publish', '_set_frame_media'}
 
-    async def login(self, username, password):
-        return await sync_to_async(self._login)(username, password, sync=True)
 
-    @replicated
-    def _logout(self, username):
+class ReadOnlyError(Exception):
+    pass
+
+
+class LocalAPI(object):
+    """
+    Queries served from the local database. On its own it is a read-only
+    API, enough to render pages as 'piebus build' does without joining
+    the cluster; PiebusAPI adds the replicated writes.
+    """
+
+    def __init__(self):
+        self.frame_listeners = []
+        self.unpublish_listeners = []
+        self.preferences = PreferenceCache()
+
+    async def write(self, name, *args):
+        raise ReadOnlyError(f'{name} needs a cluster node')
+
+    def write_token(self):
+        return 0
+
+    async def wait_applied(self, token, timeout):
         return True
 
+    def snapshot_restored(self):
+        search_cache.clear()
+        self.preferences.load()
+
+    def _frames_changed(self, frame_ids):
+        search_cache.clear()
+        for listener in self.frame_listeners:
+            listener(frame_ids)
+
+    def _frames_unpublished(self, uuids):
+        for listener in self.unpublish_listeners:
+            listener(uuids)
+
+    async def login(self, username, password):
+        user = await db_readers.run(User.get_or_none, User.username == username)
+        if not user:
+            return False
+        return await cpu_threads.run(check_password, password, user.password)
+
     async def logout(self, username):
-        return await sync_to_async(self._logout)(username, sync=True)
+        return True
 
     def _get_preference(self, key, default=None):
-        pref = Preference.get_or_none(key=key)
-        if pref is None:
-            return default
-        return pref.value if pref.value is not None else default
-
-    @replicated
-    def _set_preference(self, key, value):
-        pref = Preference.get_or_none(key=key)
-        if pref is not None:
-            q = Preference.update(value=value).where(Preference.key == key)
-            q.execute()
-        else:
-            Preference.create(key=key, value=value)
-        return value
+        return self.preferences.get(key, default)
 
     async def preference(self, key, value=None):
         if value is not None:
-            await sync_to_async(self._set_preference)(key, value, sync=True)
+            await self.write('_set_preference', key, value)
         return self._get_preference(key)
 
+    async def preference_json(self, key, default=None):
+        return self.preferences.get_json(key, default)
+
     async def enable_register(self, value=None):
         if value is not None:
-            await sync_to_async(self._set_preference)('enable_register', 1 if value else 0, sync=True)
-        return bool(int(self._get_preference('enable_register', 0)))
+            await self.write('_set_preference', 'enable_register', 1 if value else 0)
+        return self.preferences.get_bool('enable_register')
 
-    @replicated
-    def _create_frame(self, kind, name, data, meta, publish, render, source, tags):
-        frame = Frame.create(
-            uuid=uuid4().hex,
-            kind=int(kind) if kind != '' else 1,
-            name=name,
-            data=json.dumps(data) or '',
-            meta=json.dumps(meta) or '',
-            publish=publish or False,
-            render=render or 'default',
-            source=source or '',
-            tags=tags or '',
-        )
-        return frame
+    async def list_frames(self, limit=10, before=None):
+        return await db_readers.run(paginate, Frame.select(), limit, before)
 
-    async def create_frame(self, kind, name, data=None, meta=None, publish=False, render='', tags=''):
-        source = meta.get('source', '') if meta else ''
-        frame = await sync_to_async(self._create_frame)(kind=kind, name=name,
-                                                        data=data, meta=meta,
-                                                        publish=publish, render=render,
-                                                        source=source, tags=tags,
-                                                        sync=True)
-        await sync_to_async(FTSEntry.index_frame)(frame)
+    async def search_frames(self, query, page=1, per_page=10):
+        return await db_readers.run(search, query, public=False, page=page, per_page=per_page)
+
+    async def search_public_frames(self, query, page=1, per_page=10):
+        return await db_readers.run(search, query, public=True, page=page, per_page=per_page)
+
+    async def list_public_frames(self, limit=10, before=None):
+        frames = Frame.select() \
+            .where(Frame.publish == True)
+        return await db_readers.run(paginate, frames, limit, before)
+
+    async def filter_frames(self, public=False, limit=10, before=None, **filters):
+        """
+        Page through frames by promoted columns: chat_id, from_id,
+        content_type and has_location.
+        """
+        frames = Frame.select()
+        if public:
+            frames = frames.where(Frame.publish == True)
+        return await db_readers.run(paginate, filter_query(frames, **filters), limit, before)
+
+    async def frames_from_ids(self, frame_ids):
+        frames = Frame.select().where(Frame.id.in_(list(frame_ids)))
+        return await db_readers.run(list, frames)
+
+    async def frame_from_uuid(self, uuid):
+        frame = await db_readers.run(Frame.get, Frame.uuid == uuid)
         return frame
 
-    async def list_frames(self, limit=10):
-        frames = Frame.select().order_by(Frame.timestamp.desc()).limit(limit)
-        return frames
 
-    @replicated
-    def _index_frames(self):
-        frames = Frame.select().order_by(Frame.timestamp.desc())
-        for frame in frames:
-            FTSEntry.index_frame(frame)
+class PiebusAPI(LocalAPI, SyncObj):
+    def __init__(self, *args, **kwargs):
+        SyncObj.__init__(self, *args, **kwargs)
+        LocalAPI.__init__(self)
+        self.batcher = CommandBatcher(self._submit_batch, max_batch=int(conf['cluster']['batch_max']))
+        self.frame_writer = GroupCommit(self._commit_frame_rows,
+                                        window=int(conf['database']['group_commit_ms']) / 1000,
+                                        max_batch=int(conf['database']['group_commit_max']))
+
+    # Replicated methods mutate state and run on every node, the leader
+    # orders them and pysyncobj forwards commands from followers to it.
+    # Reads and password checks stay local to the node serving the
+    # request.
+
+    def replicate(self, method, *args):
+        """
+        Call a replicated method and return a future for its result,
+        resolved from pysyncobj's callback instead of a blocked thread.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def resolve(result, error):
+            if future.done():
+                return
+            if error == FAIL_REASON.SUCCESS:
+                future.set_result(result)
+            else:
+                future.set_exception(ReplicationError(f'{method.__name__} failed: {error}'))
+
+        method(*args, callback=lambda result, error: loop.call_soon_threadsafe(resolve, result, error))
+        return future
 
-    async def index_frames(self):
-        await sync_to_async(self._index_frames)(sync=True)
+    async def _submit_batch(self, commands):
+        return await self.replicate(self._apply_batch, commands)
+
+    @replicated
+    def _apply_batch(self, commands):
+        results = []
+        for name, args in commands:
+            if name not in BATCHED_COMMANDS:
+                results.append((False, f'{name} cannot be batched'))
+                continue
+            try:
+                results.append((True, getattr(self, name)(*args, _doApply=True)))
+            except Exception as e:
+                traceback.print_exc()
+                results.append((False, str(e)))
+        return results
+
+    async def write(self, name, *args):
+        return await self.batcher.run(name, *args)
+
+    def applied_index(self):
+        return self.getStatus()['last_applied']
+
+    def write_token(self):
+        """
+        Raft index covering every write this node has committed; a node
+        that has applied up to it reflects them all.
+        """
+        return self.getStatus()['commit_idx']
+
+    async def wait_applied(self, token, timeout):
+        deadline = time.monotonic() + timeout
+        while self.applied_index() < token:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
         return True
 
-    async def search_frames(self, query):
-        frames = Frame \
-            .select() \
-            .join(FTSEntry, on=(Frame.id == FTSEntry.docid)) \
-            .where(FTSEntry.match(query)).order_by(Frame.timestamp.desc())
-        return frames
+    @replicated
+    def _register(self, username, hashed):
+        try:
+            User.create(username=username, password=hashed)
+            return True
+        except:
+            traceback.print_exc()
+            return False
 
-    async def search_public_frames(self, query):
-        frames = Frame \
-            .select() \
-            .join(FTSEntry, on=(Frame.id == FTSEntry.docid)) \
-            .where((FTSEntry.match(query)) & (Frame.publish == True)).order_by(Frame.timestamp.desc())
-        return frames
+    async def register(self, username, password):
+        hashed = await cpu_threads.run(hash_password, password)
+        return await self.write('_register', username, hashed)
 
-    async def list_public_frames(self, limit=10):
-        frames = Frame.select() \
-            .where(Frame.publish == True) \
-            .order_by(Frame.timestamp.desc()) \
-            .limit(limit)
+    @replicated
+    def _set_preference(self, key, value):
+        pref = Preference.get_or_none(key=key)
+        if pref is not None:
+            q = Preference.update(value=value).where(Preference.key == key)
+            q.execute()
+        else:
+            Preference.create(key=key, value=value)
+        self.preferences.set(key, value)
+        return value
+
+    @replicated
+    def _create_frames(self, rows):
+        frames = insert_frames(rows)
+        self._frames_changed([frame.id for frame in frames])
         return frames
 
-    async def frame_from_uuid(self, uuid):
-        frame = Frame.get(Frame.uuid == uuid)
+    async def create_frames(self, batch):
+        rows = [frame_row(**frame) for frame in batch]
+        return await self.write('_create_frames', rows)
+
+    async def _commit_frame_rows(self, rows):
+        return await self.write('_create_frames', rows)
+
+    async def create_frame(self, kind, name, data=None, meta=None, publish=False, render='', tags=''):
+        """
+        Create one frame through the group commit pipeline: frames created
+        concurrently are written in one transaction and one log entry.
+        """
+        row = frame_row(kind=kind, name=name, data=data, meta=meta,
+                        publish=publish, render=render, tags=tags)
+        return await self.frame_writer.submit(row)
+
+    @replicated
+    def _publish(self, uuid, status):
+        frame = Frame.get_or_none(Frame.uuid == uuid)
+        if frame is None:
+            return None
+        was_public = frame.publish
+        frame.publish = status
+        frame.save()
+        self._frames_changed([frame.id])
+        if was_public and not status:
+            self._frames_unpublished([frame.uuid])
         return frame
 
     async def publish(self, uuid, status):
-        frame = Frame.get(Frame.uuid == uuid)
-        frame.publish = status
-        await sync_to_async(frame.save)()
+        frame = await self.write('_publish', uuid, status)
+        if frame is None:
+            raise Frame.DoesNotExist(f'No frame with uuid {uuid}')
         return frame
+
+    @replicated
+    def _set_frame_media(self, uuid, media_url):
+        frame = Frame.get_or_none(Frame.uuid == uuid)
+        if frame is None:
+            return None
+        data = dict(frame.jdata, media_url=media_url)
+        frame.data = json_dumps(data)
+        frame.promote()
+        frame.save()
+        self._frames_changed([frame.id])
+        return frame
+
+    async def set_frame_media(self, uuid, media_url):
+        frame = await self.write('_set_frame_media', uuid, media_url)
+        if frame is None:
+            raise Frame.DoesNotExist(f'No frame with uuid {uuid}')
+        return frame
+
+    async def fetch_map(self, frame):
+        """
+        Render the map of a location frame in the media pool and set it as
+        the frame's media on every node.
+        """
+        data, lat, lon = frame._location()
+        path = await media_pool.run(render_location_map, lat, lon, conf['paths']['content'],
+                                    f'map_{frame.uuid}.png')
+        return await self.set_frame_media(frame.uuid, path)
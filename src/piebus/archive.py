@@ -0,0 +1,254 @@
+import datetime
+import gzip
+import io
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+from .api import Frame, Kind, frame_row, insert_frames, plain_text
+from .codec import json_dumps, json_loads
+from .indexer import index_batch
+
+FRAME_FIELDS = ('uuid', 'timestamp', 'kind', 'name', 'data', 'meta', 'publish', 'render', 'source', 'tags')
+
+
+def open_text(path, mode='rt'):
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8')
+
+
+def read_records(path):
+    """
+    Yield records from a JSONL file one line at a time, or from a JSON
+    document holding a list of records (or a Telegram export with a
+    `messages` list), which has to be loaded whole.
+    """
+    with open_text(path) as f:
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        if head == '[' or (head == '{' and path.endswith(('.json', '.json.gz'))):
+            document = json_loads(head + f.read())
+            if isinstance(document, dict):
+                document = document.get('messages', [document])
+            yield from document
+            return
+        first = head + f.readline()
+        if first.strip():
+            yield json_loads(first)
+        for line in f:
+            if line.strip():
+                yield json_loads(line)
+
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.utcfromtimestamp(value)
+    return datetime.datetime.fromisoformat(value)
+
+
+def decode_json(value):
+    if isinstance(value, str):
+        try:
+            return json_loads(value) if value else None
+        except ValueError:
+            pass
+    return value
+
+
+def desktop_message(record):
+    """
+    Flatten the formatted text of a Telegram Desktop export message into
+    the plain string a Bot API message has, keeping the parts as
+    text_entities like newer exports do.
+    """
+    for key in ('text', 'caption'):
+        parts = record.get(key)
+        if isinstance(parts, list):
+            record = dict(record, **{key: plain_text(parts)})
+            record.setdefault(f'{key}_entities', parts)
+    return record
+
+
+def record_to_frame(record):
+    if 'name' in record and 'kind' in record:
+        frame = {field: record[field] for field in FRAME_FIELDS if field in record}
+        frame['data'] = decode_json(frame.get('data'))
+        frame['meta'] = decode_json(frame.get('meta'))
+    else:
+        frame = dict(kind=Kind.event, name='telegram-message', data=desktop_message(record),
+                     render='telegram', timestamp=record.get('date'))
+    frame['timestamp'] = parse_timestamp(frame.get('timestamp'))
+    return frame
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_frames(path, write, batch_size=1000, progress=None):
+    """
+    Read records from `path` and hand them to `write` `batch_size` at a
+    time: an ImportClient sends them to a running node, insert_records
+    writes them to the local database.
+    """
+    stats = dict(frames=0, seconds=0.0, rate=0.0)
+    started = time.perf_counter()
+    for batch in batches(read_records(path), batch_size):
+        write(batch)
+        stats['frames'] += len(batch)
+        stats['seconds'] = time.perf_counter() - started
+        stats['rate'] = stats['frames'] / stats['seconds'] if stats['seconds'] else 0.0
+        if progress:
+            progress(stats)
+    return stats
+
+
+def insert_records(records):
+    """
+    Offline import: one transaction and one search index batch per call,
+    straight into the SQLite file. Nothing is replicated and a running
+    server would not notice the new frames, so only use it on a single
+    node project whose server is stopped. Frames whose uuid already
+    exists are left alone, so an import can be re-run.
+    """
+    rows = [frame_row(**record_to_frame(record)) for record in records]
+    index_batch(insert_frames(rows))
+
+
+class ImportFailed(Exception):
+    pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+class ImportClient(object):
+    """
+    Posts records as JSONL to /frames/import.jsonl of a running node,
+    logged in as `username`. The node creates them through the
+    replicated create_frames, so they reach every cluster node and the
+    search index like any other write.
+    """
+
+    def __init__(self, url, username, password):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(), NoRedirect())
+        self.login(username, password)
+
+    def post(self, path, data, content_type):
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': content_type})
+        try:
+            return self.opener.open(request), 200
+        except urllib.error.HTTPError as e:
+            return e, e.code
+
+    def login(self, username, password):
+        form = urllib.parse.urlencode(dict(username=username, password=password)).encode('utf-8')
+        # a successful login redirects, a failed one renders the form again
+        response, status = self.post('/login/', form, 'application/x-www-form-urlencoded')
+        if status != 302:
+            raise ImportFailed(f'cannot log in to {self.url} as {username} (HTTP {status})')
+
+    def __call__(self, records):
+        body = ''.join(json_dumps(record) + '\n' for record in records).encode('utf-8')
+        response, status = self.post('/frames/import.jsonl', body, 'application/x-ndjson')
+        if status != 200:
+            raise ImportFailed(f'{self.url} refused the import (HTTP {status})')
+        return json_loads(response.read())['frames']
+
+
+def records_to_frames(text):
+    return [record_to_frame(json_loads(line)) for line in text.splitlines() if line.strip()]
+
+
+def frame_record(frame):
+    return dict(
+        uuid=frame.uuid,
+        timestamp=frame.timestamp.isoformat(),
+        kind=frame.kind,
+        name=frame.name,
+        data=decode_json(frame.data),
+        meta=decode_json(frame.meta),
+        publish=frame.publish,
+        render=frame.render,
+        source=frame.source,
+        tags=frame.tags,
+    )
+
+
+def frame_line(frame):
+    return json_dumps(frame_record(frame)) + '\n'
+
+
+def export_query(kind=None, name=None, publish=None, since=None, until=None):
+    # only the exported columns, so a database that has not been migrated
+    # yet, e.g. one being backed up before an upgrade, exports too
+    query = Frame.select(Frame.id, *[getattr(Frame, field) for field in FRAME_FIELDS])
+    if kind is not None:
+        query = query.where(Frame.kind == kind)
+    if name:
+        query = query.where(Frame.name == name)
+    if publish is not None:
+        query = query.where(Frame.publish == publish)
+    if since:
+        query = query.where(Frame.timestamp >= since)
+    if until:
+        query = query.where(Frame.timestamp < until)
+    return query
+
+
+def export_batch(query, after_id=0, batch_size=1000):
+    return list(query.where(Frame.id > after_id).order_by(Frame.id).limit(batch_size))
+
+
+def export_frames(path, compress=None, **filters):
+    """
+    Write frames matching `filters` to `path` as JSONL, streaming rows
+    off a server-side cursor so memory use does not grow with the
+    archive. Output is gzipped when `compress` is set or the path ends
+    in .gz.
+    """
+    if compress and path != '-' and not path.endswith('.gz'):
+        path += '.gz'
+    count = 0
+    if compress and path == '-':
+        out = gzip.open(sys.stdout.buffer, 'wt', encoding='utf-8')
+    else:
+        out = open_text(path, 'wt')
+    try:
+        for frame in export_query(**filters).order_by(Frame.id).iterator():
+            out.write(frame_line(frame))
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+
+class GzipStream(object):
+    def __init__(self):
+        self._compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
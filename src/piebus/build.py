@@ -0,0 +1,86 @@
+import glob
+import os
+import shutil
+
+from . import conf, media
+from .api import Frame
+from .migrations import migrate_database
+
+PAGES = ['robots.txt', '.well-known/security.txt']
+
+
+def output_path(output, url):
+    path = url.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    return os.path.join(output, path)
+
+
+async def export_url(client, output, url):
+    response = await client.get(url)
+    if response.status_code != 200:
+        print(f'skipped {url}: {response.status_code}')
+        return response.status_code
+    path = output_path(output, url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(await response.get_data())
+    return response.status_code
+
+
+def export_resized(output, url):
+    filename = os.path.basename(url)
+    image_format = media.image_format(filename)
+    source = os.path.join(conf['paths']['content'], filename)
+    if not image_format or not os.path.exists(source):
+        return
+    for width in media.resize_widths():
+        path = os.path.join(output, 'resize', str(width), 'content', filename)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            media.resize_image(source, path, width, image_format)
+
+
+def copy_tree(source, destination, ignore=None):
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(source, destination, ignore=ignore)
+
+
+async def build_site(app, output):
+    """
+    Export the public pages and published frames to `output` as plain
+    files, laid out so that a web server can serve them directly.
+    """
+    migrate_database()
+    app.config['STATIC_EXPORT'] = True
+    client = app.test_client()
+    content = conf['paths']['content']
+    urls = ['/', '/live/'] + PAGES
+    for path in sorted(glob.glob(os.path.join(content, '*.md'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name != 'index':
+            urls.append(f'/{name}/')
+    frame_urls = []
+    for frame in Frame.select().where(Frame.publish == True).order_by(Frame.id).iterator():
+        frame_urls.append(f'/frame/{frame.uuid}/')
+        media_url = frame.jdata.get('media_url')
+        if media_url:
+            export_resized(output, media_url)
+    exported = frames = 0
+    failed = []
+    for url in urls:
+        status = await export_url(client, output, url)
+        if status == 200:
+            exported += 1
+        elif status != 404:  # pages without a source file are optional
+            failed.append(url)
+    for url in frame_urls:
+        if await export_url(client, output, url) == 200:
+            frames += 1
+        else:
+            failed.append(url)
+    copy_tree(app.static_folder, os.path.join(output, 'static'))
+    copy_tree(content, os.path.join(output, 'content'),
+              ignore=shutil.ignore_patterns('.*', '*.md'))
+    return dict(pages=exported, frames=frames, failed=failed)
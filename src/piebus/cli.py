@@ -1,5 +1,6 @@
 import asyncio
 import os
+import shutil
 import click
 
 from uuid import uuid4
@@ -12,6 +13,16 @@ def main():
     pass
 
 
+def configure_app(app, register=False):
+    app.static_folder = conf['paths']['static']
+    app.static_url_path = '/static'
+    app.config['CONTENT_FOLDER'] = conf['paths']['content']
+    app.config['SECRET_KEY'] = conf['webapp']['secret_key']
+    app.config['APP_NAME'] = conf['webapp']['name']
+    app.config['ENABLE_REGISTER'] = register or conf['webapp']['register']
+    app.config['COPYRIGHT'] = conf['owner']['copyright']
+
+
 @main.command()
 @click.argument('path')
 @click.option('--template', default='default')
@@ -37,18 +48,18 @@ def init(path, template, security_contact):
 @click.option('--telegram/--no-telegram', default=False)
 @click.option('--host', default='127.0.0.1')
 @click.option('--port', default='5000')
-def serve(path, debug, reload, register, telegram, host, port):
+@click.option('--cluster-self', default=None, help='This node\'s raft address, host:port.')
+@click.option('--partners', default=None, help='Comma separated raft addresses of the other nodes.')
+@click.option('--bind', default=None, help='Address to bind the raft port to, if not the self address.')
+def serve(path, debug, reload, register, telegram, host, port, cluster_self, partners, bind):
     global PATH_CURRENT, APP_NAME
     PATH_CURRENT = os.path.expanduser(path)
+    for key, value in (('self', cluster_self), ('partners', partners), ('bind', bind)):
+        if value is not None:
+            conf['cluster'][key] = value
     from .server import app
     os.chdir(os.path.expanduser(path))
-    app.static_folder = conf['paths']['static']
-    app.static_url_path = '/static'
-    app.config['CONTENT_FOLDER'] = conf['paths']['content']
-    app.config['SECRET_KEY'] = conf['webapp']['secret_key']
-    app.config['APP_NAME'] = conf['webapp']['name']
-    app.config['ENABLE_REGISTER'] = register or conf['webapp']['register']
-    app.config['COPYRIGHT'] = conf['owner']['copyright']
+    configure_app(app, register)
     tg = None
     if telegram:
         from .agents.telegram import start
@@ -63,5 +74,244 @@ def serve(path, debug, reload, register, telegram, host, port):
         loop.run_until_complete(tg())
 
 
+@main.command()
+@click.argument('path', default='.')
+@click.option('--full/--no-full', default=False, help='Rebuild the index from scratch.')
+@click.option('--since', type=click.DateTime(), default=None, help='Reindex frames created since this date.')
+@click.option('--batch-size', default=500)
+def reindex(path, full, since, batch_size):
+    os.chdir(os.path.expanduser(path))
+    from .indexer import FrameIndexer
+    from .migrations import migrate_database
+    migrate_database()
+    indexer = FrameIndexer(batch_size=batch_size)
+
+    def progress(status):
+        click.echo(f'\rIndexed {status["indexed"]}/{status["total"]} frames', nl=False)
+
+    indexer.run(full=full, since=since, progress=progress)
+    click.echo(f'\nDone, high-water mark is at frame {indexer.high_water_mark()}.')
+
+
+@main.command()
+@click.argument('path', default='.')
+@click.option('--output', default='public', help='Directory to write the static site to.')
+def build(path, output):
+    os.chdir(os.path.expanduser(path))
+    # read the local database only, a raft node here would share its
+    # identity and snapshot with a 'piebus serve' of the same project
+    conf['cluster']['self'] = ''
+    from .build import build_site
+    from .server import app
+    configure_app(app)
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(build_site(app, os.path.abspath(output)))
+    click.echo(f'Exported {result["pages"]} pages and {result["frames"]} published frames to {output}/')
+    if result['failed']:
+        raise click.ClickException(f'{len(result["failed"])} pages failed: {", ".join(result["failed"])}')
+
+
+@main.command(name='import')
+@click.argument('source')
+@click.option('--url', default='http://127.0.0.1:5000', help='Running piebus node to import through.')
+@click.option('--username', envvar='PIEBUS_USERNAME', default=None)
+@click.option('--password', envvar='PIEBUS_PASSWORD', default=None)
+@click.option('--offline/--no-offline', default=False,
+              help='Write to the database of the project at --path directly, with its server stopped.')
+@click.option('--path', default='.', help='Project directory to import into with --offline.')
+@click.option('--batch-size', default=1000)
+def import_(source, url, username, password, offline, path, batch_size):
+    """
+    Import frames from a JSON/JSONL file ("-" for stdin).
+
+    Frames are sent to the node at --url, which replicates them to the
+    rest of the cluster. --offline writes to the local database instead,
+    which only suits a single node project whose server is stopped.
+    """
+    from .archive import ImportClient, ImportFailed, import_frames, insert_records
+    if source != '-':
+        source = os.path.abspath(os.path.expanduser(source))
+    if offline:
+        os.chdir(os.path.expanduser(path))
+        if conf['cluster']['partners'].strip():
+            raise click.ClickException('--offline writes to the local database only and would not reach '
+                                       'the other cluster nodes; import through a running node instead')
+        from .api import ensure_db
+        from .migrations import migrate_database
+        ensure_db()
+        migrate_database()
+        write = insert_records
+    else:
+        username = username or click.prompt('Username', err=True)
+        password = password or click.prompt('Password', hide_input=True, err=True)
+        try:
+            write = ImportClient(url, username, password)
+        except (ImportFailed, OSError) as e:
+            raise click.ClickException(str(e))
+
+    def progress(stats):
+        click.echo(f'\rImported {stats["frames"]} frames, {stats["rate"]:.0f} frames/s', nl=False)
+
+    try:
+        stats = import_frames(source, write, batch_size=batch_size, progress=progress)
+    except (ImportFailed, OSError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f'\nDone, {stats["frames"]} frames in {stats["seconds"]:.1f}s.')
+
+
+@main.command(name='export')
+@click.argument('output', default='-')
+@click.option('--path', default='.', help='Project directory to export from.')
+@click.option('--kind', type=int, default=None)
+@click.option('--name', default=None)
+@click.option('--publish', type=click.Choice(['all', 'public', 'private']), default='all')
+@click.option('--since', type=click.DateTime(), default=None)
+@click.option('--until', type=click.DateTime(), default=None)
+@click.option('--gzip/--no-gzip', default=False)
+def export(output, path, kind, name, publish, since, until, gzip):
+    """Export frames as JSONL to OUTPUT ("-" for stdout)."""
+    if output != '-':
+        output = os.path.abspath(os.path.expanduser(output))
+    os.chdir(os.path.expanduser(path))
+    from .archive import export_frames
+    count = export_frames(output, compress=gzip, kind=kind, name=name,
+                          publish={'all': None, 'public': True, 'private': False}[publish],
+                          since=since, until=until)
+    click.echo(f'Exported {count} frames.', err=True)
+
+
+@main.command(name='migrate')
+@click.argument('path', default='.')
+@click.option('--status/--no-status', default=False, help='Only show pending migrations.')
+def migrate_(path, status):
+    """Bring the database schema up to date."""
+    os.chdir(os.path.expanduser(path))
+    from .migrations import migrate_database, pending_migrations, schema_version
+    click.echo(f'Schema version {schema_version()}.')
+    if status:
+        for version, migration in pending_migrations():
+            click.echo(f'Pending: {version} {migration.__name__}')
+        return
+
+    def progress(version, migration):
+        click.echo(f'Applying {version} {migration.__name__}...')
+
+    applied = migrate_database(progress=progress)
+    click.echo(f'Applied {len(applied)} migrations, schema version {schema_version()}.')
+
+
+@main.group()
+def db():
+    """Database maintenance."""
+
+
+@db.command()
+@click.argument('path', default='.')
+@click.option('--codec', type=click.Choice(['json', 'zlib', 'zstd', 'msgpack']), default=None,
+              help='Target codec, defaults to [database] codec in piebus.conf.')
+@click.option('--batch-size', default=500)
+@click.option('--dry-run/--no-dry-run', default=False, help='Only report what would be saved.')
+def recode(path, codec, batch_size, dry_run):
+    """Convert stored frame payloads to another codec."""
+    os.chdir(os.path.expanduser(path))
+    from .api import recode_frames
+    from .migrations import migrate_database
+    migrate_database()
+    codec = codec or conf['database']['codec']
+
+    def progress(stats):
+        click.echo(f'\rRecoded {stats["frames"]} frames', nl=False)
+
+    stats = recode_frames(codec, batch_size=batch_size, dry_run=dry_run, progress=progress)
+    saved = stats['bytes_before'] - stats['bytes_after']
+    ratio = stats['bytes_after'] / stats['bytes_before'] if stats['bytes_before'] else 1.0
+    click.echo(f'\n{"Would change" if dry_run else "Changed"} {stats["changed"]} of {stats["frames"]} frames.')
+    click.echo(f'Payload bytes: {stats["bytes_before"]} -> {stats["bytes_after"]} '
+               f'({saved} saved, {ratio:.0%} of before).')
+    for label in ('before', 'after'):
+        seconds = stats[f'decode_{label}']
+        rate = stats['frames'] / seconds if seconds else 0.0
+        click.echo(f'Decode {label}: {seconds * 1000:.1f}ms, {rate:.0f} frames/s')
+    if saved > 0 and not dry_run:
+        click.echo('Run VACUUM to return the freed pages to the filesystem.')
+
+
+@db.command()
+@click.argument('path', default='.')
+@click.option('--sql/--no-sql', default=False, help='Print the SQL of every query too.')
+def explain(path, sql):
+    """Print query plans for every PiebusAPI query."""
+    os.chdir(os.path.expanduser(path))
+    from .migrations import explain_queries, migrate_database
+    migrate_database()
+    for name, query, plan in explain_queries():
+        click.echo(name)
+        if sql:
+            click.echo(f'  {query}')
+        for step in plan:
+            click.echo(f'  {step}')
+
+
+@db.command()
+@click.argument('path', default='.')
+@click.option('--task', 'tasks', multiple=True,
+              type=click.Choice(['checkpoint', 'optimize', 'analyze', 'fts_optimize', 'vacuum']),
+              help='Run only these tasks, may be repeated.')
+@click.option('--vacuum/--no-vacuum', default=False, help='Also VACUUM the database.')
+def maintain(path, tasks, vacuum):
+    """Checkpoint the WAL, refresh statistics and merge search index segments."""
+    os.chdir(os.path.expanduser(path))
+    from .maintenance import database_stats, run_tasks
+    from .migrations import migrate_database
+    migrate_database()
+    if not tasks:
+        tasks = ['fts_optimize', 'analyze', 'optimize'] + (['vacuum'] if vacuum else []) + ['checkpoint']
+
+    def report(label, stats):
+        click.echo(f'{label}: {stats["db_bytes"]} bytes, WAL {stats["wal_bytes"]} bytes, '
+                   f'{stats["page_count"]} pages, {stats["freelist_count"]} free')
+
+    report('Before', database_stats())
+    for name, seconds in run_tasks(tasks).items():
+        click.echo(f'{name}: {seconds:.2f}s')
+    report('After', database_stats())
+
+
+@main.group()
+def cluster():
+    """Cluster membership."""
+
+
+@cluster.command()
+@click.argument('peer')
+@click.option('--path', default='.', help='Project directory of the joining node.')
+@click.option('--snapshot', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Copy of a member's snapshot file to start from.")
+def join(peer, path, snapshot):
+    """
+    Prepare this node to join the cluster PEER is a member of.
+
+    With --snapshot the local database is restored from it, so the node
+    only replays the log written after the snapshot was taken. Without
+    one the leader sends its latest snapshot once the node connects.
+    """
+    if snapshot:
+        snapshot = os.path.abspath(os.path.expanduser(snapshot))
+    os.chdir(os.path.expanduser(path))
+    from .cluster import SQLiteSnapshots
+    address = conf['cluster']['self']
+    if snapshot:
+        shutil.copyfile(snapshot, conf['cluster']['snapshot'])
+        SQLiteSnapshots(address).deserialize(conf['cluster']['snapshot'])
+        click.echo(f'Restored the database from {snapshot}.')
+    if conf['cluster'].getboolean('dynamic_membership'):
+        from pysyncobj.syncobj_admin import Utility
+        result = Utility(['-conn', peer, '-add', address]).getResult()
+        click.echo(f'{peer}: {result}')
+    else:
+        click.echo(f'Dynamic membership is off, add {address} to [cluster] partners on every node.')
+    click.echo(f'Start this node with partners set in piebus.conf, then run: piebus serve {path}')
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,210 @@
+"""
+Cluster plumbing: raft snapshots backed by SQLite, and batching of
+replicated commands.
+
+The replicated state lives in the SQLite database, not in the SyncObj,
+so a pysyncobj full dump is a copy of the database made with SQLite's
+online backup API, plus the raft bookkeeping pysyncobj asks us to keep
+with it. Once a dump exists the log before it is dropped, and a node
+that joins or falls too far behind receives the dump in chunks
+(logCompactionBatchSize) instead of replaying every command.
+
+pysyncobj calls the serializer on its tick thread, so the copy runs on
+a thread of its own and pysyncobj polls `check` for the outcome.
+"""
+import asyncio
+import datetime
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from pysyncobj import SyncObjConf
+from pysyncobj.config import SERIALIZER_STATE
+
+from . import PATH_DATABASE, conf
+
+SNAPSHOT_TABLE = 'piebus_snapshot'
+
+
+def partner_addresses(value):
+    return [address.strip() for address in value.split(',') if address.strip()]
+
+
+class SQLiteSnapshots(object):
+    """
+    pysyncobj serializer/deserializer pair.
+
+    A snapshot is a standalone SQLite file. Loading one made by another
+    node restores it over the local database; loading our own, as on a
+    restart, only hands the raft data back since the database already
+    holds that state.
+    """
+
+    def __init__(self, address, database=PATH_DATABASE, path=None, backup_pages=4096):
+        self.address = address
+        self.database = database
+        self.path = path or conf['cluster']['snapshot']
+        self.backup_pages = backup_pages
+        self.restore_listeners = []
+        self.state = SERIALIZER_STATE.NOT_SERIALIZING
+        self.stats = dict(created=0, restored=0, last_created=None, last_restored=None,
+                          bytes=0, seconds=0.0, running=False, error=None)
+
+    def backup(self, source, target, pages=None):
+        source.backup(target, pages=pages or self.backup_pages)
+
+    def serialize(self, filename, raft_data):
+        """
+        Start a snapshot of the state raft has applied so far.
+
+        Opening a read transaction here pins that state under WAL, the copy
+        then runs on its own thread, in a single backup step so writes made
+        meanwhile cannot restart it, and is renamed into `self.path` when
+        complete. pysyncobj's own rename of `filename` right after we return
+        finds nothing to move; `check` reports the real outcome.
+        """
+        if self.stats['running']:
+            return
+        if os.path.exists(filename):
+            os.remove(filename)  # left over from a synchronous serializer
+        source = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False)
+        source.execute('BEGIN')
+        source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        self.state = SERIALIZER_STATE.SERIALIZING
+        self.stats['running'] = True
+        threading.Thread(target=self.write, args=(source, pickle.dumps(raft_data)),
+                         name='piebus-snapshot', daemon=True).start()
+
+    def write(self, source, raft_data):
+        started = time.perf_counter()
+        partial = f'{self.path}.part'
+        try:
+            if os.path.exists(partial):
+                os.remove(partial)
+            target = sqlite3.connect(partial)
+            try:
+                self.backup(source, target, pages=-1)
+                target.execute('PRAGMA journal_mode=delete')
+                target.execute(f'CREATE TABLE {SNAPSHOT_TABLE} (key TEXT PRIMARY KEY, value BLOB)')
+                target.executemany(f'INSERT INTO {SNAPSHOT_TABLE} VALUES (?, ?)',
+                                   [('raft', raft_data), ('origin', self.address)])
+                target.commit()
+            finally:
+                target.close()
+            os.replace(partial, self.path)
+        except Exception as e:
+            self.stats.update(running=False, error=str(e))
+            self.state = SERIALIZER_STATE.FAILED
+            return
+        finally:
+            source.close()
+        self.stats.update(created=self.stats['created'] + 1, last_created=datetime.datetime.utcnow(),
+                          bytes=os.path.getsize(self.path), seconds=round(time.perf_counter() - started, 3),
+                          running=False, error=None)
+        self.state = SERIALIZER_STATE.SUCCESS
+
+    def check(self):
+        state = self.state
+        if state in (SERIALIZER_STATE.SUCCESS, SERIALIZER_STATE.FAILED):
+            self.state = SERIALIZER_STATE.NOT_SERIALIZING
+        return state
+
+    def deserialize(self, filename):
+        snapshot = sqlite3.connect(filename)
+        try:
+            meta = dict(snapshot.execute(f'SELECT key, value FROM {SNAPSHOT_TABLE}'))
+            if meta['origin'] != self.address:
+                self.restore(snapshot)
+                snapshot.execute(f'UPDATE {SNAPSHOT_TABLE} SET value = ? WHERE key = ?',
+                                 (self.address, 'origin'))
+                snapshot.commit()
+            return pickle.loads(meta['raft'])
+        finally:
+            snapshot.close()
+
+    def restore(self, snapshot):
+        target = sqlite3.connect(self.database)
+        try:
+            self.backup(snapshot, target)
+            target.execute(f'DROP TABLE IF EXISTS {SNAPSHOT_TABLE}')
+            target.commit()
+        finally:
+            target.close()
+        self.stats.update(restored=self.stats['restored'] + 1, last_restored=datetime.datetime.utcnow())
+        for listener in self.restore_listeners:
+            listener()
+
+
+def syncobj_conf(section, snapshots):
+    return SyncObjConf(
+        bindAddress=section['bind'] or None,
+        fullDumpFile=snapshots.path,
+        serializer=snapshots.serialize,
+        serializeChecker=snapshots.check,
+        deserializer=snapshots.deserialize,
+        logCompactionMinEntries=int(section['compaction_entries']),
+        logCompactionMinTime=int(section['compaction_seconds']),
+        logCompactionBatchSize=int(section['transfer_chunk_kb']) * 1024,
+        dynamicMembershipChange=section.getboolean('dynamic_membership'),
+    )
+
+
+class ReplicationError(Exception):
+    pass
+
+
+class CommandBatcher(object):
+    """
+    Coalesces replicated commands issued concurrently on this node into
+    one raft log entry.
+
+    While a batch is being committed new commands queue up and go out
+    together in the next one, so a lone writer pays no extra latency and
+    a burst costs one round trip per batch instead of one per command.
+    """
+
+    def __init__(self, submit, max_batch=64):
+        self.submit = submit
+        self.max_batch = max_batch
+        self.pending = []
+        self.flushing = False
+        self.batches = 0
+        self.commands = 0
+
+    async def run(self, name, *args):
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append(((name, args), future))
+        if not self.flushing:
+            self.flushing = True
+            asyncio.ensure_future(self.flush())
+        return await future
+
+    async def flush(self):
+        try:
+            while self.pending:
+                batch = self.pending[:self.max_batch]
+                self.pending = self.pending[self.max_batch:]
+                try:
+                    results = await self.submit([command for command, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.commands += len(batch)
+                for (_, future), (ok, result) in zip(batch, results):
+                    if future.done():
+                        continue
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(ReplicationError(result))
+        finally:
+            self.flushing = False
+
+    def stats(self):
+        return dict(batches=self.batches, commands=self.commands, pending=len(self.pending),
+                    mean_batch=round(self.commands / self.batches, 2) if self.batches else 0.0)
@@ -0,0 +1,115 @@
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def json_loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def json_dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj)
+
+
+class PayloadError(Exception):
+    pass
+
+
+def _zlib_encode(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def _zlib_decode(blob):
+    return zlib.decompress(blob).decode('utf-8')
+
+
+def _zstd_encode(text):
+    return zstandard.ZstdCompressor(level=6).compress(text.encode('utf-8'))
+
+
+def _zstd_decode(blob):
+    if zstandard is None:
+        raise PayloadError('zstd payload found but zstandard is not installed')
+    return zstandard.ZstdDecompressor().decompress(blob).decode('utf-8')
+
+
+def _msgpack_encode(text):
+    return msgpack.packb(json_loads(text), use_bin_type=True)
+
+
+def _msgpack_decode(blob):
+    if msgpack is None:
+        raise PayloadError('msgpack payload found but msgpack is not installed')
+    return json_dumps(msgpack.unpackb(blob, raw=False))
+
+
+# name: (tag, encode, decode, available)
+PAYLOAD_CODECS = {
+    'zlib': (b'z', _zlib_encode, _zlib_decode, True),
+    'zstd': (b's', _zstd_encode, _zstd_decode, zstandard is not None),
+    'msgpack': (b'm', _msgpack_encode, _msgpack_decode, msgpack is not None),
+}
+PAYLOAD_DECODERS = {tag[0]: decode for tag, _, decode, _ in PAYLOAD_CODECS.values()}
+
+
+def payload_codec(name):
+    """
+    Resolve a configured codec name; `json` (plain text) is None. zstd
+    and msgpack fall back to zlib when their package is not installed.
+    """
+    name = (name or 'json').strip().lower()
+    if name in ('', 'json', 'text', 'none'):
+        return None
+    if name not in PAYLOAD_CODECS:
+        raise PayloadError(f'Unknown payload codec: {name!r}')
+    if not PAYLOAD_CODECS[name][3]:
+        print(f'{name} is not installed, storing payloads with zlib')
+        return 'zlib'
+    return name
+
+
+def encode_payload(text, codec):
+    """
+    Encode JSON text for storage. The blob starts with a one byte codec
+    tag so rows written with different codecs can live side by side;
+    payloads that would not get smaller are kept as plain text.
+    """
+    if not text or codec is None:
+        return text
+    tag, encode, _, _ = PAYLOAD_CODECS[codec]
+    blob = tag + encode(text)
+    if len(blob) >= len(text.encode('utf-8')):
+        return text
+    return blob
+
+
+def decode_payload(value):
+    if not isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    value = bytes(value)
+    try:
+        decode = PAYLOAD_DECODERS[value[0]]
+    except (KeyError, IndexError):
+        raise PayloadError(f'Unknown payload tag: {value[:1]!r}')
+    return decode(value[1:])
@@ -0,0 +1,194 @@
+"""
+Background downloads of Telegram media.
+
+The bot creates a message's frame straight away and queues its media
+here. A fixed number of workers stream each file from the Telegram file
+API into a temporary file next to its destination, rename it into the
+content directory once it is complete, and then hand its path, e.g.
+content/img_<hex>.jpg, to a callback, which sets the frame's media_url.
+"""
+import asyncio
+import os
+from uuid import uuid4
+
+import aiofiles
+
+from . import conf
+from .cluster import ReplicationError
+from .workers import WorkerPoolBusy
+
+# content type: (file name prefix, suffix)
+MEDIA_TYPES = {
+    'photo': ('img_', 'jpg'),
+    'voice': ('voi_', 'oga'),
+    'video_note': ('vin_', 'mp4'),
+    'video': ('vid_', 'mp4'),
+    'sticker': ('stk_', 'webp'),
+}
+
+
+class DownloadError(Exception):
+    retry = True
+
+
+class TooLarge(DownloadError):
+    retry = False
+
+
+def media_file(data):
+    """
+    Content type and Telegram file object of the media attached to a
+    message, or (None, None). Stickers are fetched as their thumbnail.
+    """
+    if data.get('photo'):
+        return 'photo', data['photo'][-1]
+    for kind in ('voice', 'video_note', 'video'):
+        if data.get(kind):
+            return kind, data[kind]
+    if data.get('sticker') and data['sticker'].get('thumb'):
+        return 'sticker', data['sticker']['thumb']
+    return None, None
+
+
+class MediaDownloads(object):
+    def __init__(self, section, api_base, token, directory):
+        self.section = section
+        self.api_base = api_base.rstrip('/')
+        self.token = token
+        self.directory = directory
+        self.concurrency = int(section['concurrency'])
+        self.queue_max = int(section['queue_max'])
+        self.retries = int(section['retries'])
+        self.retry_backoff = float(section['retry_backoff'])
+        self.chunk_size = int(section['chunk_kb']) * 1024
+        self.queue = None
+        self.session = None
+        self.workers = []
+        self.counters = dict(queued=0, active=0, done=0, failed=0, retried=0, too_large=0, bytes=0)
+        self.last_error = None
+
+    def limit(self, kind):
+        return int(float(self.section.get(f'max_mb_{kind}', self.section['max_mb'])) * 1024 * 1024)
+
+    def start(self):
+        import aiohttp
+        self.queue = asyncio.Queue()
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=float(self.section['timeout'])))
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def submit(self, uuid, kind, file, on_done):
+        """
+        Queue the download of `file`, a Telegram file object, for the frame
+        `uuid`; `await on_done(uuid, path)` runs once it is in place.
+        """
+        if self.queue is None:
+            self.start()
+        if self.queue.qsize() >= self.queue_max:
+            raise WorkerPoolBusy(self.retry_backoff)
+        self.counters['queued'] += 1
+        self.queue.put_nowait((uuid, kind, file, on_done, 0, None))
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            self.counters['active'] += 1
+            try:
+                await self.run(*job)
+            finally:
+                self.counters['active'] -= 1
+
+    async def run(self, uuid, kind, file, on_done, attempt, path):
+        """
+        Download `file` unless `path` holds it from an earlier attempt, then
+        run `on_done`. A retry after a failed `on_done`, e.g. when the
+        media_url could not be replicated, reuses the file.
+        """
+        import aiohttp
+        try:
+            if path is None:
+                path = await self.download(kind, file)
+            await on_done(uuid, path)
+        except (DownloadError, ReplicationError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self.last_error = f'{uuid}: {e!r}'
+            if getattr(e, 'retry', True) and attempt < self.retries:
+                self.counters['retried'] += 1
+                delay = self.retry_backoff * 2 ** attempt
+                asyncio.get_event_loop().call_later(delay, self.queue.put_nowait,
+                                                    (uuid, kind, file, on_done, attempt + 1, path))
+                return
+            self.failed(e, path)
+        except Exception as e:
+            self.last_error = f'{uuid}: {e!r}'
+            self.failed(e, path)
+        else:
+            self.counters['done'] += 1
+
+    def failed(self, error, path):
+        # no frame points at the file, don't leave it in content/
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+        self.counters['too_large' if isinstance(error, TooLarge) else 'failed'] += 1
+        print('media download failed:', self.last_error)
+
+    async def file_url(self, file_id):
+        url = f'{self.api_base}/bot{self.token}/getFile'
+        async with self.session.get(url, params={'file_id': file_id}) as response:
+            if response.status >= 500 or response.status == 429:
+                raise DownloadError(f'getFile: HTTP {response.status}')
+            body = await response.json()
+        if not body.get('ok'):
+            raise DownloadError(f'getFile: {body.get("description")}')
+        result = body['result']
+        return f'{self.api_base}/file/bot{self.token}/{result["file_path"]}', result.get('file_size') or 0
+
+    async def download(self, kind, file):
+        limit = self.limit(kind)
+        if (file.get('file_size') or 0) > limit:
+            raise TooLarge(f'{kind} of {file["file_size"]} bytes exceeds {limit}')
+        url, size = await self.file_url(file['file_id'])
+        if size > limit:
+            raise TooLarge(f'{kind} of {size} bytes exceeds {limit}')
+        prefix, suffix = MEDIA_TYPES[kind]
+        filename = f'{prefix}{uuid4().hex}.{suffix}'
+        path = os.path.join(self.directory, filename)
+        partial = os.path.join(self.directory, f'.{filename}.part')
+        try:
+            await self.stream(kind, url, partial, limit)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return path
+
+    async def stream(self, kind, url, path, limit):
+        async with self.session.get(url) as response:
+            if response.status != 200:
+                error = DownloadError(f'{kind} download: HTTP {response.status}')
+                error.retry = response.status >= 500 or response.status == 429
+                raise error
+            if (response.content_length or 0) > limit:
+                raise TooLarge(f'{response.content_length} bytes exceeds {limit}')
+            written = 0
+            async with aiofiles.open(path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    written += len(chunk)
+                    if written > limit:
+                        raise TooLarge(f'more than {limit} bytes')
+                    await f.write(chunk)
+        self.counters['bytes'] += written
+
+    def stats(self):
+        return dict(self.counters, pending=self.queue.qsize() if self.queue is not None else 0,
+                    concurrency=self.concurrency, last_error=self.last_error)
+
+
+media_downloads = MediaDownloads(conf['downloads'], conf['telegram-bot']['file_api'],
+                                 conf['telegram-bot']['token'], conf['paths']['content'])
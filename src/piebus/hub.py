@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+
+def sse_message(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+
+class Hub(object):
+    """
+    In-process pub/sub for server-sent events.
+
+    Every client gets a small bounded queue; a client that falls behind
+    far enough to fill it is dropped rather than allowed to hold
+    messages for everyone else. Messages are encoded once, by the
+    publisher, so an idle client costs one queue.
+    """
+
+    def __init__(self, clients, queue_size=16):
+        self.clients = clients
+        self.queue_size = queue_size
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.clients.discard(queue)
+
+    def publish(self, message):
+        self.published += 1
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.drop(queue)
+
+    def drop(self, queue):
+        self.unsubscribe(queue)
+        self.dropped += 1
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def stream(self, keepalive=30):
+        queue = self.subscribe()
+        try:
+            yield b': connected\n\n'
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            self.unsubscribe(queue)
+
+    def stats(self):
+        return dict(clients=len(self.clients), published=self.published, dropped=self.dropped)
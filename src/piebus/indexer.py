@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+import threading
+import time
+
+from .api import db, Frame, FTSEntry, Preference, search_cache
+
+HIGH_WATER_MARK = 'fts_high_water_mark'
+
+
+def index_batch(frames):
+    rows = []
+    empty = []
+    for frame in frames:
+        content = FTSEntry.frame_content(frame)
+        if content.strip():
+            rows.append({FTSEntry.rowid: frame.id, FTSEntry.content: content})
+        else:
+            empty.append(frame.id)
+    with db.atomic():
+        if rows:
+            FTSEntry.insert_many(rows).on_conflict_replace().execute()
+        if empty:
+            FTSEntry.delete().where(FTSEntry.rowid.in_(empty)).execute()
+    search_cache.clear()
+    return len(rows)
+
+
+class FrameIndexer(object):
+    """
+    Keeps the full text index up to date in batched transactions.
+
+    Only frames above the stored high-water mark are indexed unless a
+    full rebuild or a `since` timestamp is asked for.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.task = None
+        self.status = dict(running=False, indexed=0, total=0,
+                           started=None, finished=None, error=None)
+
+    @staticmethod
+    def high_water_mark():
+        pref = Preference.get_or_none(key=HIGH_WATER_MARK)
+        return int(pref.value) if pref else 0
+
+    @staticmethod
+    def set_high_water_mark(frame_id):
+        Preference.insert(key=HIGH_WATER_MARK, value=str(frame_id)) \
+            .on_conflict(conflict_target=[Preference.key],
+                         update={Preference.value: str(frame_id)}) \
+            .execute()
+
+    @staticmethod
+    def reset():
+        FTSEntry.delete().execute()
+        Preference.delete().where(Preference.key == HIGH_WATER_MARK).execute()
+
+    def run(self, full=False, since=None, progress=None):
+        if full:
+            self.reset()
+        high_water_mark = self.high_water_mark()
+        if since is not None:
+            where = Frame.timestamp >= since
+        else:
+            where = Frame.id > high_water_mark
+        self.status.update(running=True, indexed=0, error=None,
+                           total=Frame.select().where(where).count(),
+                           started=datetime.datetime.utcnow(), finished=None)
+        last_id = 0
+        try:
+            while True:
+                frames = list(Frame.select()
+                              .where(where & (Frame.id > last_id))
+                              .order_by(Frame.id)
+                              .limit(self.batch_size))
+                if not frames:
+                    break
+                index_batch(frames)
+                last_id = frames[-1].id
+                if last_id > high_water_mark:
+                    high_water_mark = last_id
+                    self.set_high_water_mark(last_id)
+                self.status['indexed'] += len(frames)
+                if progress:
+                    progress(self.status)
+        except Exception as e:
+            self.status['error'] = str(e)
+            raise
+        finally:
+            self.status.update(running=False, finished=datetime.datetime.utcnow())
+        return self.status['indexed']
+
+    def start(self, full=False, since=None):
+        if self.status['running']:
+            return self.task
+        self.status['running'] = True
+        loop = asyncio.get_event_loop()
+        self.task = loop.run_in_executor(None, self.run, full, since)
+        return self.task
+
+
+class IndexQueue(object):
+    """
+    Write-behind queue that keeps the search index in sync with frame
+    writes without making the writer wait for it.
+
+    Frame ids are coalesced while they wait and flushed in batches by a
+    background thread every `interval` seconds, or sooner once
+    `batch_size` ids are pending.
+    """
+
+    def __init__(self, interval=0.5, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flushed = 0
+        self.last_flush = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def put(self, frame_ids):
+        now = time.monotonic()
+        with self._lock:
+            for frame_id in frame_ids:
+                self._pending.setdefault(frame_id, now)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    @property
+    def lag(self):
+        with self._lock:
+            if not self._pending:
+                return 0.0
+            return time.monotonic() - min(self._pending.values())
+
+    def stats(self):
+        return dict(pending=len(self._pending), lag=round(self.lag, 3),
+                    flushed=self.flushed, last_flush=self.last_flush)
+
+    def requeue(self, pending):
+        with self._lock:
+            for frame_id, queued in pending.items():
+                self._pending[frame_id] = min(queued, self._pending.get(frame_id, queued))
+
+    @staticmethod
+    def index(batch):
+        with db.atomic():
+            frames = list(Frame.select().where(Frame.id.in_(batch)))
+            missing = set(batch) - {frame.id for frame in frames}
+            if missing:
+                FTSEntry.delete().where(FTSEntry.rowid.in_(list(missing))).execute()
+            index_batch(frames)
+            if batch[-1] > FrameIndexer.high_water_mark():
+                FrameIndexer.set_high_water_mark(batch[-1])
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        frame_ids = sorted(pending)
+        for start in range(0, len(frame_ids), self.batch_size):
+            batch = frame_ids[start:start + self.batch_size]
+            try:
+                self.index(batch)
+            except Exception:
+                # keep the failed batch and everything after it for the next
+                # flush, so the high-water mark never moves past them
+                self.requeue({frame_id: pending[frame_id] for frame_id in frame_ids[start:]})
+                raise
+            self.flushed += len(batch)
+        self.last_flush = datetime.datetime.utcnow()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                if self._pending:
+                    self.flush()
+            except Exception as e:
+                print('search index flush failed:', e)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='piebus-index-queue', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        if self._pending:
+            self.flush()
+
+
+indexer = FrameIndexer()
+index_queue = IndexQueue()
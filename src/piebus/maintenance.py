@@ -0,0 +1,158 @@
+import datetime
+import os
+import threading
+import time
+
+from . import PATH_DATABASE, conf
+from .api import db, FTSEntry
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def database_stats():
+    page_size = db.pragma('page_size')
+    page_count = db.pragma('page_count')
+    freelist_count = db.pragma('freelist_count')
+    return dict(
+        db_bytes=file_size(PATH_DATABASE),
+        wal_bytes=file_size(PATH_DATABASE + '-wal'),
+        page_size=page_size,
+        page_count=page_count,
+        freelist_count=freelist_count,
+        free_ratio=round(freelist_count / page_count, 3) if page_count else 0.0,
+    )
+
+
+def checkpoint():
+    return db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+
+
+def optimize():
+    db.execute_sql('PRAGMA optimize')
+
+
+def analyze():
+    db.execute_sql('ANALYZE')
+
+
+def fts_optimize():
+    table = FTSEntry._meta.table_name
+    db.execute_sql(f'INSERT INTO "{table}"("{table}") VALUES (\'optimize\')')
+
+
+def vacuum():
+    db.execute_sql('VACUUM')
+    checkpoint()
+
+
+TASKS = dict(
+    checkpoint=checkpoint,
+    optimize=optimize,
+    analyze=analyze,
+    fts_optimize=fts_optimize,
+    vacuum=vacuum,
+)
+
+
+def run_tasks(names):
+    """
+    Run maintenance tasks by name, in the order given, and return how
+    long each one took.
+    """
+    timings = {}
+    for name in names:
+        started = time.perf_counter()
+        TASKS[name]()
+        timings[name] = time.perf_counter() - started
+    return timings
+
+
+class Maintenance(object):
+    """
+    Runs database housekeeping from a background thread once the server
+    has been idle for `idle_seconds`: a WAL checkpoint, PRAGMA optimize,
+    ANALYZE and FTS segment merges, each on its own interval, and VACUUM
+    when enabled and enough pages are free. A checkpoint is also forced,
+    idle or not, once the WAL grows past `wal_max_mb`.
+    """
+
+    def __init__(self, section):
+        self.idle_seconds = float(section['idle_seconds'])
+        self.check_interval = float(section['check_interval'])
+        self.wal_max_bytes = int(section['wal_max_mb']) * 1024 * 1024
+        self.vacuum = section.getboolean('vacuum')
+        self.vacuum_free_ratio = float(section['vacuum_free_ratio'])
+        self.intervals = dict(
+            fts_optimize=float(section['fts_optimize_interval']),
+            analyze=float(section['analyze_interval']),
+            optimize=float(section['optimize_interval']),
+            checkpoint=float(section['checkpoint_interval']),
+        )
+        self.last_activity = time.monotonic()
+        self.last_run = {}
+        self.history = {}
+        self.error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def touch(self, *args):
+        self.last_activity = time.monotonic()
+
+    @property
+    def idle(self):
+        return time.monotonic() - self.last_activity >= self.idle_seconds
+
+    def due(self):
+        now = time.monotonic()
+        tasks = []
+        if self.idle:
+            tasks = [name for name, interval in self.intervals.items()
+                     if now - self.last_run.get(name, 0.0) >= interval]
+            if self.vacuum and database_stats()['free_ratio'] >= self.vacuum_free_ratio:
+                tasks.append('vacuum')
+        elif file_size(PATH_DATABASE + '-wal') > self.wal_max_bytes:
+            tasks = ['checkpoint']
+        return tasks
+
+    def run(self, tasks):
+        for name, seconds in run_tasks(tasks).items():
+            self.last_run[name] = time.monotonic()
+            self.history[name] = dict(at=datetime.datetime.utcnow(), seconds=round(seconds, 3))
+
+    def stats(self):
+        return dict(database_stats(), idle=self.idle, error=self.error, tasks=self.history)
+
+    def _run(self):
+        # don't start with a burst of work right after a restart
+        self.last_run = {name: time.monotonic() for name in self.intervals}
+        while not self._stopped.wait(self.check_interval):
+            try:
+                if not os.path.exists(PATH_DATABASE):
+                    continue
+                tasks = self.due()
+                if tasks:
+                    self.run(tasks)
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                print('database maintenance failed:', e)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='piebus-maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+
+maintenance = Maintenance(conf['maintenance'])
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from PIL import Image, ImageDraw
+
+from . import conf
+from .workers import media_pool
+
+IMAGE_FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+}
+
+MIMETYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+}
+
+
+def image_format(filename):
+    return IMAGE_FORMATS.get(filename.rsplit('.', 1)[-1].lower())
+
+
+def resize_widths():
+    widths = conf['media']['resize_widths'].split(',')
+    return sorted({int(width) for width in widths if width.strip()})
+
+
+def bucket_width(width, widths=None):
+    """
+    Round a requested width up to the nearest configured width,
+    clamping anything larger to the widest bucket.
+    """
+    widths = widths or resize_widths()
+    for bucket in widths:
+        if width <= bucket:
+            return bucket
+    return widths[-1]
+
+
+def resize_image(source, destination, width, format):
+    image = Image.open(source)
+    image.thumbnail((width, width), Image.ANTIALIAS)
+    partial = f'{destination}.{uuid4().hex}.part'
+    image.save(partial, format, quality=80)
+    os.replace(partial, destination)
+    return destination
+
+
+def render_location_map(lat, lon, content, fname):
+    import smopy
+    map = smopy.Map((lat - 0.006, lon - 0.038, lat + 0.006, lon + 0.038), z=12,
+                    tileserver="http://tile.basemaps.cartocdn.com/light_all/{z}/{x}/{y}@2x.png",
+                    tilesize=512, maxtiles=16)
+    x, y = map.to_pixels(lat, lon)
+    x = int(x)
+    y = int(y)
+    map.save_png(os.path.join(content, fname))
+    img = Image.open(open(os.path.join(content, fname), 'rb'))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([(x-10, y-10), (x+10, y+10)], fill=128,  width=10)
+    del draw
+    path = os.path.join(content, f'loc_{fname}')
+    img.save(path, "PNG")
+    return path
+
+
+class ResizeCache(object):
+    """
+    Resized images on disk, keyed on (source, mtime, width, format).
+
+    Entries are evicted least recently used first once the cache grows
+    past `max_bytes`; hits bump the file mtime so the order survives a
+    restart.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(source, mtime, width, format):
+        token = f'{source}:{mtime}:{width}:{format}'
+        return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+    def filename(self, key, format):
+        return os.path.join(self.path, f'{key}.{format.lower()}')
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.part'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries = OrderedDict()
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+        self.size = sum(self._entries.values())
+
+    def get(self, key, format):
+        path = self.filename(key, format)
+        name = os.path.basename(path)
+        with self._lock:
+            self._load()
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.discard(name)
+            return None
+        return path
+
+    def add(self, key, format):
+        path = self.filename(key, format)
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._load()
+            self.size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            evicted = self._evict()
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+        return path
+
+    def discard(self, name):
+        with self._lock:
+            self.size -= self._entries.pop(name, 0)
+
+    def _evict(self):
+        evicted = []
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(name)
+        return evicted
+
+    async def render(self, source, key, width, format):
+        with self._lock:
+            self._load()
+        await media_pool.run(resize_image, source, self.filename(key, format), width, format)
+        return self.add(key, format)
+
+
+resize_cache = ResizeCache(conf['media']['resize_cache'],
+                           int(conf['media']['resize_cache_max_mb']) * 1024 * 1024)
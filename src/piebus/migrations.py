@@ -0,0 +1,153 @@
+"""
+Versioned schema migrations.
+
+The schema version is kept in SQLite's `PRAGMA user_version`; every
+migration runs once, in its own transaction, in order. New databases
+are created at the latest version by `ensure_db`.
+"""
+import datetime
+import os
+
+from peewee import BooleanField, CharField, IntegerField
+from playhouse.migrate import SqliteMigrator, migrate
+
+from . import PATH_DATABASE
+from .api import (
+    db,
+    Frame,
+    Preference,
+    User,
+    SCHEMA_VERSION,
+    backfill_promoted_fields,
+    encode_cursor,
+    ensure_search_index,
+    filter_query,
+    page_query,
+    search_query,
+)
+
+
+class SchemaError(Exception):
+    pass
+
+
+def create_index(table, *columns):
+    db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{table}_{"_".join(columns)}" '
+                   f'ON "{table}" ({", ".join(columns)})')
+
+
+def drop_index(name):
+    db.execute_sql(f'DROP INDEX IF EXISTS "{name}"')
+
+
+def timestamp_id_index():
+    create_index('frame', 'timestamp', 'id')
+
+
+def fts5_search_index():
+    ensure_search_index()
+
+
+def promoted_columns():
+    columns = {column.name for column in db.get_columns('frame')}
+    fields = dict(
+        chat_id=IntegerField(null=True),
+        from_id=IntegerField(null=True),
+        media_url=CharField(default=''),
+        has_location=BooleanField(default=False),
+        content_type=CharField(default=''),
+    )
+    migrator = SqliteMigrator(db)
+    migrate(*[migrator.add_column('frame', name, field)
+              for name, field in fields.items() if name not in columns])
+    backfill_promoted_fields()
+    for column in ('chat_id', 'from_id', 'content_type'):
+        create_index('frame', column, 'timestamp', 'id')
+
+
+def query_indexes():
+    """
+    Drop indexes no query uses; listings of published frames seek on
+    (publish, timestamp, id) and the rest on (timestamp, id).
+    """
+    for name in ('frame_name', 'frame_tags', 'frame_render', 'frame_publish',
+                 'frame_timestamp', 'user_note', 'user_timestamp', 'preference_timestamp'):
+        drop_index(name)
+    create_index('frame', 'publish', 'timestamp', 'id')
+
+
+def location_index():
+    create_index('frame', 'has_location', 'timestamp', 'id')
+
+
+MIGRATIONS = [
+    timestamp_id_index,
+    fts5_search_index,
+    promoted_columns,
+    query_indexes,
+    location_index,
+]
+assert len(MIGRATIONS) == SCHEMA_VERSION
+
+
+def schema_version():
+    return db.pragma('user_version')
+
+
+def pending_migrations():
+    version = schema_version()
+    if version > len(MIGRATIONS):
+        raise SchemaError(f'Database schema version {version} is newer than this piebus '
+                          f'({len(MIGRATIONS)}), upgrade piebus.')
+    return list(enumerate(MIGRATIONS, start=1))[version:]
+
+
+def migrate_database(progress=None):
+    """
+    Apply pending migrations to an existing database and return their
+    names; a missing database is left for `ensure_db` to create.
+    """
+    if not os.path.exists(PATH_DATABASE):
+        return []
+    applied = []
+    for version, migration in pending_migrations():
+        if progress:
+            progress(version, migration)
+        with db.atomic():
+            migration()
+            db.pragma('user_version', version)
+        applied.append(migration.__name__)
+    return applied
+
+
+def api_queries():
+    """
+    One instance of every query shape `PiebusAPI` issues, for EXPLAIN.
+    """
+    frames = Frame.select()
+    public = frames.where(Frame.publish == True)
+    cursor = encode_cursor(Frame(id=1, timestamp=datetime.datetime(2020, 1, 1)))
+    return [
+        ('list_frames', page_query(frames, 10)),
+        ('list_frames before', page_query(frames, 10, cursor)),
+        ('list_public_frames', page_query(public, 10)),
+        ('list_public_frames before', page_query(public, 10, cursor)),
+        ('filter_frames chat_id', page_query(filter_query(frames, chat_id=1), 10)),
+        ('filter_frames from_id', page_query(filter_query(frames, from_id=1), 10)),
+        ('filter_frames content_type', page_query(filter_query(frames, content_type='photo'), 10)),
+        ('filter_frames has_location', page_query(filter_query(frames, has_location=True), 10)),
+        ('filter_frames public chat_id', page_query(filter_query(public, chat_id=1), 10)),
+        ('frame_from_uuid', Frame.select().where(Frame.uuid == 'uuid')),
+        ('frames_from_ids', Frame.select().where(Frame.id.in_([1, 2, 3]))),
+        ('search_frames', search_query('piebus', False, 0, 11)),
+        ('search_public_frames', search_query('piebus', True, 0, 11)),
+        ('login', User.select().where(User.username == 'owner')),
+        ('preferences', Preference.select()),
+    ]
+
+
+def explain_queries():
+    for name, query in api_queries():
+        sql, params = query.sql()
+        plan = db.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        yield name, sql, [row[-1] for row in plan]
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import deque
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class GroupCommit(object):
+    """
+    Collects items submitted within `window` seconds of the first one,
+    or until `max_batch` are waiting, and hands them to `commit` in one
+    call; every caller gets its own result back.
+
+    `commit` takes a list of items and returns a list of results in the
+    same order. If it fails, every caller in the batch gets the error.
+    """
+
+    def __init__(self, commit, window=0.005, max_batch=200):
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.batches = 0
+        self.items = 0
+        self.largest = 0
+        self.latencies = deque(maxlen=1024)
+        self.sizes = deque(maxlen=1024)
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.pending:
+            batch = self.pending[:self.max_batch]
+            self.pending = self.pending[self.max_batch:]
+            asyncio.ensure_future(self._commit(batch))
+
+    async def _commit(self, batch):
+        started = time.perf_counter()
+        try:
+            results = await self.commit([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        self.batches += 1
+        self.items += len(batch)
+        self.largest = max(self.largest, len(batch))
+        self.sizes.append(len(batch))
+        self.latencies.append(time.perf_counter() - started)
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return dict(
+            batches=self.batches,
+            items=self.items,
+            pending=len(self.pending),
+            mean_batch=round(self.items / self.batches, 2) if self.batches else 0.0,
+            recent_mean_batch=round(sum(self.sizes) / len(self.sizes), 2) if self.sizes else 0.0,
+            largest_batch=self.largest,
+            commit_ms=dict(p50=round(percentile(latencies, 0.5) * 1000, 2),
+                           p99=round(percentile(latencies, 0.99) * 1000, 2),
+                           max=round(max(latencies, default=0.0) * 1000, 2)),
+        )
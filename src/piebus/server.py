@@ -1,5 +1,6 @@
 import asyncio
 import base64
+import calendar
 import functools
 import io
 import json
@@ -7,15 +8,16 @@ import os
 from datetime import datetime
 
 import aiofiles
+import jinja2
 from functools import lru_cache
 
-from PIL import Image
 from asgiref.sync import sync_to_async
 from piebus import conf
 from piebus.utils import telegram_markdown
 from quart import (
     abort,
     flash,
+    jsonify,
     Quart,
     redirect,
     request,
@@ -25,13 +27,52 @@ from quart import (
     session,
     url_for,
 )
+from jinja2 import Markup
+from werkzeug.http import http_date, parse_date, parse_etags
 from werkzeug.utils import secure_filename
-from .api import PiebusAPI, ensure_db, Kind
+from . import archive, media
+from .api import LocalAPI, PiebusAPI, decode_cursor, ensure_db, Kind, loop
+from .cache import LRUCache
+from .downloads import media_downloads
+from .cluster import SQLiteSnapshots, partner_addresses, syncobj_conf
+from .hub import Hub, sse_message
+from .indexer import indexer, index_queue
+from .maintenance import maintenance
+from .migrations import migrate_database
 from .utils import render_markdown
+from .workers import cpu_threads, db_readers, media_pool, WorkerPoolBusy
+
+
+
+def create_api(section, snapshots):
+    """
+    This process's raft node, or with an empty `self` address a read-only
+    view of the local database that joins no cluster, as 'piebus build'
+    needs.
+    """
+    if not section['self']:
+        return LocalAPI()
+    api = PiebusAPI(section['self'], partner_addresses(section['partners']),
+                    conf=syncobj_conf(section, snapshots))
+    snapshots.restore_listeners.append(api.snapshot_restored)
+    return api
+
 
 app = Quart('piebus')
-api = PiebusAPI('127.0.0.1:8008', [])
+snapshots = SQLiteSnapshots(conf['cluster']['self'], backup_pages=int(conf['cluster']['backup_pages']))
+api = create_api(conf['cluster'], snapshots)
 admin_sse_clients = set()
+live_sse_clients = set()
+page_cache = {}
+fragment_cache = LRUCache(maxsize=int(conf['webapp']['fragment_cache_size']))
+admin_hub = Hub(admin_sse_clients, queue_size=int(conf['webapp']['sse_queue_size']))
+live_hub = Hub(live_sse_clients, queue_size=int(conf['webapp']['sse_queue_size']))
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'css', 'js', 'py', 'sh',
                       'jpg', 'png', 'gif',
@@ -103,6 +144,105 @@ async def frame_from_form(form):
     return frame
 
 
+def cursor_arg():
+    before = request.args.get('before')
+    if before:
+        try:
+            decode_cursor(before)
+        except ValueError:
+            abort(400)
+    return before
+
+
+def filter_args():
+    filters = {}
+    try:
+        for key in ('chat_id', 'from_id'):
+            if request.args.get(key):
+                filters[key] = int(request.args[key])
+    except ValueError:
+        abort(400)
+    if request.args.get('content_type'):
+        filters['content_type'] = request.args['content_type']
+    if request.args.get('has_location'):
+        filters['has_location'] = request.args['has_location'] not in ('0', 'no', 'off')
+    return filters
+
+
+def page_arg():
+    try:
+        return max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        abort(400)
+
+
+async def render_frames(template, frames, next_url=None, stream_url=None):
+    if app.config.get('STATIC_EXPORT'):
+        next_url = stream_url = None
+    if await intercooler_request(request):
+        template = 'includes/frames.html'
+    return await render(template, frames=frames, next_url=next_url,
+                        stream_url=stream_url, Kind=Kind)
+
+
+@jinja2.contextfunction
+async def render_frame(context, frame):
+    """
+    Render a frame through includes/frame_item.html, reusing the HTML
+    while its uuid, revision, renderer, auth state and humanized age
+    are unchanged.
+
+    Quart's Jinja environment is async, so the fragment is rendered with
+    render_async and the calling template awaits the result.
+    """
+    session = context.get('session') or {}
+    key = (frame.revision, frame.render, bool(session.get('logged_in')), humanize_ts(frame.timestamp))
+    fragments = fragment_cache.get(frame.uuid)
+    if fragments is None:
+        fragments = fragment_cache.set(frame.uuid, {})
+    html = fragments.get(key)
+    if html is None:
+        if len(fragments) >= 8:
+            fragments.clear()
+        template = context.environment.get_template('includes/frame_item.html')
+        html = fragments[key] = Markup(await template.render_async(context.get_all(), frame=frame))
+    return html
+
+
+async def broadcast_frames(frames):
+    # public clients only ever hear of published frames, removals are
+    # sent by frames_unpublished
+    public = [frame for frame in frames if frame.publish]
+    if live_sse_clients and public:
+        async with app.test_request_context('/live/'):
+            for frame in public:
+                html = await render('includes/frame_item.html', frame=frame, Kind=Kind)
+                live_hub.publish(sse_message('frame', dict(uuid=frame.uuid, html=html)))
+    if admin_sse_clients:
+        async with app.test_request_context('/frames/'):
+            session['logged_in'] = True
+            for frame in frames:
+                html = await render('includes/frame_item.html', frame=frame, Kind=Kind)
+                admin_hub.publish(sse_message('frame', dict(uuid=frame.uuid, html=html)))
+
+
+async def frames_updated(frame_ids):
+    frames = await api.frames_from_ids(frame_ids)
+    for frame in frames:
+        fragment_cache.pop(frame.uuid)
+    if admin_sse_clients or live_sse_clients:
+        await broadcast_frames(frames)
+
+
+def frames_changed(frame_ids):
+    loop.call_soon_threadsafe(asyncio.ensure_future, frames_updated(frame_ids))
+
+
+def frames_unpublished(uuids):
+    for uuid in uuids:
+        loop.call_soon_threadsafe(live_hub.publish, sse_message('frame', dict(uuid=uuid, html=None)))
+
+
 def humanize_ts(timestamp=False):
     """
     Get a datetime object or a int() Epoch timestamp and return a
@@ -156,11 +296,63 @@ def humanize_ts(timestamp=False):
     return f"{years} year{s} ago"
 
 
+@app.errorhandler(WorkerPoolBusy)
+async def worker_pool_busy(error):
+    return Response('Server is busy, please retry.', 503, {'Retry-After': str(error.retry_after)})
+
+
+@app.before_serving
+async def startup():
+    # the indexer and the preference cache both query the database,
+    # so its tables have to exist first
+    if not ensure_db():
+        migrate_database()
+    await db_readers.run(api.preferences.load)
+    indexer.start()
+    api.frame_listeners.append(index_queue.put)
+    index_queue.start()
+    api.frame_listeners.append(frames_changed)
+    api.unpublish_listeners.append(frames_unpublished)
+    if conf['maintenance'].getboolean('enabled'):
+        api.frame_listeners.append(maintenance.touch)
+        maintenance.start()
+
+
+@app.before_request
+async def track_activity():
+    maintenance.touch()
+
+
+@app.before_request
+async def read_your_writes():
+    token = session.get('applied')
+    if token and conf['cluster'].getboolean('read_your_writes'):
+        await api.wait_applied(token, float(conf['cluster']['read_your_writes_timeout']))
+
+
+@app.after_request
+async def remember_writes(response):
+    if request.method == 'POST' and session.get('logged_in') and conf['cluster'].getboolean('read_your_writes'):
+        session['applied'] = api.write_token()
+    return response
+
+
+@app.after_serving
+async def shutdown():
+    media_pool.shutdown(wait=False)
+    await media_downloads.stop()
+    maintenance.stop()
+    index_queue.stop()
+    db_readers.shutdown()
+    cpu_threads.shutdown()
+
+
 app.jinja_env.filters['humanize'] = humanize_ts
 app.jinja_env.filters['markdown'] = render_markdown
 app.jinja_env.filters['telegram_markdown'] = telegram_markdown
 app.jinja_env.line_statement_prefix = '@'
 app.jinja_env.line_comment_prefix = '##'
+app.jinja_env.globals['render_frame'] = render_frame
 
 
 @app.route('/register/', methods=['GET', 'POST'])
@@ -252,38 +444,92 @@ def content_file(filename):
     raise abort(404)
 
 
+def not_modified(etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains(etag)
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and int(last_modified) <= calendar.timegm(since.utctimetuple())
+
+
 @app.route('/resize/<int:width>/content/<path:filename>')
 async def resize_image(width, filename):
     filename = secure_filename(filename)
-    filename = 'content/' + filename
-    if filename and allowed_file(filename):
-        size = (width, width)
-        image = await sync_to_async(Image.open)(filename)
-        image.thumbnail(size, Image.ANTIALIAS)
-        mem_file = io.BytesIO()
-        quality = 80
-        await sync_to_async(image.save)(mem_file, image.format, quality=quality)
-        mem_file.seek(0)
-        resp = await sync_to_async(mem_file.read)()
-        return Response(resp, content_type=f'image/{image.format}')
-    abort(404)
+    image_format = media.image_format(filename) if filename else None
+    if not image_format:
+        abort(404)
+    source = content_path(filename)
+    try:
+        stat = os.stat(source)
+    except FileNotFoundError:
+        abort(404)
+    width = media.bucket_width(width)
+    etag = media.resize_cache.key(source, stat.st_mtime_ns, width, image_format)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f'public, max-age={conf["media"]["resize_max_age"]}',
+    }
+    if not_modified(etag, stat.st_mtime):
+        return Response('', 304, headers)
+    path = media.resize_cache.get(etag, image_format)
+    if path is None:
+        path = await media.resize_cache.render(source, etag, width, image_format)
+    async with aiofiles.open(path, 'rb') as f:
+        content = await f.read()
+    return Response(content, 200, headers, content_type=media.MIMETYPES[image_format])
+
+
+async def render_page(name, title):
+    """
+    Render content/<name>.md through page.html.
+
+    The markdown is compiled once per source mtime; for anonymous
+    visitors without pending flash messages the whole page is reused.
+    """
+    path = content_path(f'{name}.md')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        abort(404)
+    cached = page_cache.get(path)
+    if cached is None or cached['mtime'] != mtime:
+        async with aiofiles.open(path, 'r') as f:
+            content = await f.read()
+        cached = page_cache[path] = dict(mtime=mtime, post=render_markdown(content), html=None)
+    anonymous = not (session.get('logged_in') or session.get('_flashes'))
+    if anonymous and cached['html'] is not None:
+        return cached['html']
+    html = await render('page.html', title=title, post=cached['post'])
+    if anonymous:
+        cached['html'] = html
+    return html
 
 
 @app.route('/')
 async def index():
-    async with aiofiles.open(content_path('index.md'), 'r') as f:
-        content = await f.read()
-    return await render('page.html',
-                        title='home',
-                        post=render_markdown(content))
+    return await render_page('index', 'home')
+
+
+@app.route('/<name>/')
+async def content_page(name):
+    name = secure_filename(name)
+    if not name or name.startswith('.'):
+        abort(404)
+    return await render_page(name, name.replace('-', ' '))
 
 
 @app.route('/live/')
 async def live():
-    frames = await api.list_public_frames(limit=conf['webapp']['live_posts_max'])
-    if await intercooler_request(request):
-        return await render('includes/live.html', frames=frames, Kind=Kind)
-    return await render('live.html', frames=frames, Kind=Kind)
+    page = await api.list_public_frames(limit=int(conf['webapp']['live_posts_max']),
+                                        before=cursor_arg())
+    next_url = url_for('live', before=page.next) if page.next else None
+    return await render_frames('live.html', page.frames, next_url, url_for('live_stream'))
+
+
+@app.route('/live/stream')
+async def live_stream():
+    return live_hub.stream(int(conf['webapp']['sse_keepalive'])), 200, SSE_HEADERS
 
 
 @app.route('/frame/create/', methods=['GET', 'POST'])
@@ -293,7 +539,7 @@ async def frame_create():
         form = await request.form
         frame = await frame_from_form(form)
         if await intercooler_request(request):
-            return await render('includes/frame_render.html', frame=frame, Kind=Kind)
+            return await render('includes/frame_item.html', frame=frame, Kind=Kind)
         return redirect(url_for('frame_detail', uuid=frame.uuid))
     return await render('frame_create.html', Kind=Kind)
 
@@ -311,29 +557,117 @@ async def frame_detail(uuid):
 @app.route('/frames/', methods=['GET', 'POST'])
 @login_required
 async def list_frames():
-    frames = await api.list_frames(limit=100)
-    if await intercooler_request(request):
-        return await render('includes/frames.html', frames=frames, Kind=Kind)
-    return await render('frames.html', frames=frames, Kind=Kind)
+    filters = filter_args()
+    if filters:
+        page = await api.filter_frames(limit=100, before=cursor_arg(), **filters)
+    else:
+        page = await api.list_frames(limit=100, before=cursor_arg())
+    next_url = url_for('list_frames', **dict(request.args.to_dict(), before=page.next)) if page.next else None
+    return await render_frames('frames.html', page.frames, next_url, url_for('admin_stream'))
+
+
+@app.route('/admin/stream')
+@login_required
+async def admin_stream():
+    return admin_hub.stream(int(conf['webapp']['sse_keepalive'])), 200, SSE_HEADERS
+
+
+def export_filters(args):
+    publish = args.get('publish')
+    try:
+        return dict(
+            kind=int(args['kind']) if args.get('kind') else None,
+            name=args.get('name') or None,
+            publish={'true': True, 'false': False}.get(publish) if publish else None,
+            since=datetime.fromisoformat(args['since']) if args.get('since') else None,
+            until=datetime.fromisoformat(args['until']) if args.get('until') else None,
+        )
+    except ValueError:
+        abort(400)
+
+
+@app.route('/frames/export.jsonl')
+@login_required
+async def export_frames():
+    query = archive.export_query(**export_filters(request.args))
+    gzip = request.args.get('gzip') in ('1', 'true', 'on')
+
+    async def generate():
+        stream = archive.GzipStream() if gzip else None
+        last_id = 0
+        while True:
+            frames = await db_readers.run(archive.export_batch, query, last_id, 500)
+            if not frames:
+                break
+            last_id = frames[-1].id
+            chunk = ''.join(archive.frame_line(frame) for frame in frames).encode('utf-8')
+            yield stream.compress(chunk) if stream else chunk
+        if stream:
+            yield stream.flush()
+
+    filename = 'frames.jsonl.gz' if gzip else 'frames.jsonl'
+    headers = {
+        'Content-Type': 'application/gzip' if gzip else 'application/x-ndjson',
+        'Content-Disposition': f'attachment; filename={filename}',
+    }
+    return generate(), 200, headers
+
+
+@app.route('/frames/import.jsonl', methods=['POST'])
+@login_required
+async def import_frames():
+    try:
+        frames = archive.records_to_frames(await request.get_data(raw=False))
+    except ValueError:
+        abort(400)
+    created = await api.create_frames(frames)
+    return jsonify(frames=len(created))
 
 
 @app.route('/frames/ftsindex/', methods=['GET', 'POST'])
 @login_required
 async def ftsindex_frames():
-    await api.index_frames()
-    return redirect(url_for('live'))
+    indexer.start(full=(await query_or_form_field(request, 'full', '')) == 'on')
+    if await intercooler_request(request):
+        return await render('admin/search_index.html', index_status=indexer.status,
+                            index_queue=index_queue.stats())
+    return redirect(url_for('admin'))
+
+
+@app.route('/admin/search_index/')
+@login_required
+async def admin_search_index():
+    return await render('admin/search_index.html', index_status=indexer.status,
+                        index_queue=index_queue.stats())
+
+
+@app.route('/admin/metrics')
+@login_required
+async def admin_metrics():
+    metrics = dict(search_index=dict(indexer=indexer.status, queue=index_queue.stats()),
+                   streams=dict(admin=admin_hub.stats(), live=live_hub.stats()),
+                   fragments=dict(frames=len(fragment_cache),
+                                  hits=fragment_cache.hits,
+                                  misses=fragment_cache.misses),
+                   database=await db_readers.run(maintenance.stats),
+                   media_downloads=media_downloads.stats())
+    if isinstance(api, PiebusAPI):
+        metrics['cluster'] = dict(snapshots=snapshots.stats,
+                                  batcher=api.batcher.stats(),
+                                  frame_writer=api.frame_writer.stats(),
+                                  raft={key: str(value) for key, value in api.getStatus().items()})
+    return jsonify(metrics)
 
 
 @app.route('/search/', methods=['GET', 'POST'])
 async def search():
     query = await query_or_form_field(request, 'q', 'awesome')
     if session.get('logged_in'):
-        frames = await api.search_frames(query)
+        page = await api.search_frames(query, page=page_arg())
     else:
-        frames = await api.search_public_frames(query)
-    if await intercooler_request(request):
-        return await render('includes/frames.html', frames=frames, Kind=Kind)
-    return await render('frames.html', frames=frames, Kind=Kind)
+        page = await api.search_public_frames(query, page=page_arg())
+    next_url = url_for('search', q=query, page=page.next) if page.next else None
+    return await render_frames('frames.html', page.frames, next_url)
 
 
 @app.route('/admin/')
@@ -342,15 +676,17 @@ async def admin():
     enable_register = await api.enable_register()
     return await render('admin/index.html',
                         title='admin',
-                        enable_register=enable_register)
+                        enable_register=enable_register,
+                        index_status=indexer.status,
+                        index_queue=index_queue.stats(),
+                        database=await db_readers.run(maintenance.stats))
 
 
 @app.route('/admin/settings/')
 @login_required
 async def admin_settings():
     enable_register = await api.enable_register()
-    tg_settings = await api.preference('telegram_bot') or '{}'
-    tg_settings = json.loads(tg_settings)
+    tg_settings = await api.preference_json('telegram_bot', {})
     return await render('admin/settings.html',
                         title='admin',
                         enable_register=enable_register, **tg_settings)
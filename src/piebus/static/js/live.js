@@ -0,0 +1,30 @@
+(function () {
+  var recent = document.getElementById('recent');
+  if (!recent || !window.EventSource || !recent.getAttribute('data-stream')) {
+    return;
+  }
+  var source = new EventSource(recent.getAttribute('data-stream'));
+  source.addEventListener('frame', function (event) {
+    var message = JSON.parse(event.data);
+    var existing = document.getElementById('frame-' + message.uuid);
+    if (message.html === null) {
+      if (existing) {
+        existing.parentNode.removeChild(existing);
+      }
+      return;
+    }
+    var holder = document.createElement('div');
+    holder.innerHTML = message.html;
+    var item = holder.firstElementChild;
+    if (existing) {
+      existing.parentNode.replaceChild(item, existing);
+      return;
+    }
+    var first = recent.querySelector('.frame-item');
+    if (first) {
+      first.parentNode.insertBefore(item, first);
+    } else {
+      recent.appendChild(item);
+    }
+  });
+})();
@@ -1,6 +1,9 @@
+import functools
+import hashlib
 import html
 import re
 import os
+import threading
 
 import markdown
 
@@ -8,6 +11,7 @@ from cookiecutter.main import cookiecutter
 from jinja2.utils import urlize
 
 from . import PATH_COOKIECUTTER_TEMPLATES
+from .cache import LRUCache
 
 
 def cookiecutter_template_path(template_name):
@@ -18,18 +22,46 @@ def render_project(template_name, **context):
     cookiecutter(cookiecutter_template_path(template_name), extra_context=context)
 
 
-def render_markdown(content):
-    html = markdown.markdown(content, extensions=['codehilite', 'fenced_code'])
-    return html
-
+MARKDOWN_EXTENSIONS = ['codehilite', 'fenced_code']
 
 tg_tilde = re.compile(r'^~(.*)', flags=re.MULTILINE | re.UNICODE)
+tg_url = re.compile(r'(https?:[^\s\n\r]+)')
+
+_local = threading.local()
+markdown_cache = LRUCache(maxsize=2048)
+
+
+def markdown_engine():
+    """
+    Markdown instance for the current thread; building the pipeline and
+    loading extensions is most of the cost of rendering a short message.
+    """
+    engine = getattr(_local, 'markdown', None)
+    if engine is None:
+        engine = _local.markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return engine
+
+
+def memoized(render):
+    @functools.wraps(render)
+    def wrapper(content):
+        key = (render.__name__, hashlib.sha1(content.encode('utf-8')).digest())
+        html = markdown_cache.get(key)
+        if html is None:
+            html = markdown_cache.set(key, render(content))
+        return html
+
+    return wrapper
+
+
+@memoized
+def render_markdown(content):
+    return markdown_engine().reset().convert(content)
 
 
+@memoized
 def telegram_markdown(text):
     text = html.unescape(text)
-    text =  re.sub(r'(https?:[^\s\n\r]+)', r'<a href="\1">\1</a>',
-text)
+    text = tg_url.sub(r'<a href="\1">\1</a>', text)
     md = tg_tilde.sub(r'```\1', text)
-    ht = render_markdown(md)
-    return ht
+    return markdown_engine().reset().convert(md)
@@ -0,0 +1,92 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import conf
+
+
+class WorkerPoolBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Worker pool is saturated, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of worker processes for CPU heavy work.
+
+    At most `queue_max` jobs are accepted at a time, callers beyond that
+    get `WorkerPoolBusy` instead of queueing up behind a burst.
+    """
+
+    def __init__(self, processes, queue_max, retry_after):
+        self.processes = processes
+        self.queue_max = queue_max
+        self.retry_after = retry_after
+        self.pending = 0
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.pending >= self.queue_max:
+            raise WorkerPoolBusy(self.retry_after)
+        self.pending += 1
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+        except BrokenProcessPool:
+            self._executor = None
+            raise
+        finally:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+class ThreadPool(object):
+    """
+    Named pool of threads for blocking calls, e.g. SQLite queries or
+    bcrypt, both of which release the GIL.
+
+    peewee keeps one connection per thread, so every thread in the pool
+    holds its own connection; under WAL readers run in parallel.
+    """
+
+    def __init__(self, threads, name):
+        self.threads = threads
+        self.name = name
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=self.name)
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+db_readers = ThreadPool(threads=int(conf['workers']['db_readers']), name='piebus-db-read')
+cpu_threads = ThreadPool(threads=int(conf['workers']['cpu_threads']), name='piebus-cpu')
+
+media_pool = WorkerPool(processes=int(conf['workers']['media_processes']),
+                        queue_max=int(conf['workers']['media_queue_max']),
+                        retry_after=int(conf['workers']['retry_after']))